@@ -37,7 +37,7 @@ def print_canto_usage():
     print_common_usage()
 
 def print_fetch_usage():
-    print "USAGE: canto-fetch [-hvVfdbDCLF]"
+    print "USAGE: canto-fetch [-hvVfdbijpesDCLF]"
     print "--help       -h       This help."
     print "--version    -v       Print version info."
     print "--verbose    -V       Print extra info while running."
@@ -46,6 +46,9 @@ def print_fetch_usage():
     print "--background -b       Background (implies -d)"
     print "--interval   -i       Update interval when run as a daemon"
     print "--sysfp      -s       Use system feedparser instead of builtin."
+    print "--jobs       -j [num] Number of feeds to fetch at once."
+    print "--parsers    -p [num] Number of processes to parse feeds with."
+    print "--engine     -e [eng] Fetch with \"threads\" or a \"select\" loop."
     print ""
     print_common_usage()
 
@@ -9,10 +9,20 @@
 # canto client source because they share configuration and canto-fetch can
 # conveniently fit into a single file without there being too much confusion.
 
-# There are three parts, roughly.
+# There are five parts, roughly.
 # main()        -> arg parsing and (if necessary) runs the daemon loop
-# run()         -> spawns the appropriate threads
+# Schedule      -> keeps track of when each feed is next due, for the daemon
+# run()         -> queues up a FetchThread for each feed
+# FetchPool     -> runs the queued FetchThreads with bounded concurrency
 # FetchThread   -> performs the update for one feed
+# ParsePool     -> (optionally) parses the fetched feeds in other processes
+#
+# With the select engine (fetch_select.py), the network I/O is done in a single
+# loop instead, and the FetchPool only parses, merges and writes.
+#
+# When each feed is next due is worked out by fetch_rate.py, and fetch_claim.py
+# keeps canto-fetch runs in different processes out of each other's way. The
+# daemon can also have feeds pushed to it (fetch_push.py).
 
 # main is only used when canto-fetch is called from the command line.
 # run is used internally by canto when it needs to invoke an update.
@@ -23,19 +33,34 @@ feedparser = feedparser_builtin
 
 from const import VERSION_TUPLE, GIT_SHA
 from cfg.base import get_cfg
+import fetch_select
+import fetch_claim
+import fetch_http
+import fetch_push
+import fetch_rate
+import story_state
+import storage
 import utility
 import args
 
-from threading import Thread
+from threading import Thread, Condition, Timer
+from StringIO import StringIO
 import traceback
-import commands
+import copy
+import subprocess
+import tempfile
 import urlparse
 import urllib2
 import cPickle
+import base64
+import hashlib
+import heapq
+import httplib
+import urllib
+import resource
 import locale
 import socket
 import signal
-import fcntl
 import time
 import sys
 import os
@@ -43,8 +68,9 @@ import os
 def main(enc):
     conf_dir, log_file, conf_file, feed_dir, script_dir, optlist =\
         args.parse_common_args(enc,
-            "hvVfdbi:s", ["help","version","verbose","force","daemon",\
-                    "background", "interval=", "sysfp"], "canto-fetch")
+            "hvVfdbi:sj:p:e:", ["help","version","verbose","force","daemon",\
+                    "background", "interval=", "sysfp", "jobs=", "parsers=",\
+                    "engine="], "canto-fetch")
 
     try :
         cfg = get_cfg(conf_file, log_file, feed_dir, script_dir)
@@ -69,6 +95,9 @@ def main(enc):
     background = False
     verbose = False
     force = False
+    jobs = None
+    parsers = None
+    engine = None
 
     for opt, arg in optlist :
         if opt in ["-d","--daemon"]:
@@ -88,6 +117,37 @@ def main(enc):
                 cfg.log("%s isn't a valid interval" % arg)
             else:
                 cfg.log("interval = %d seconds" % updateInterval)
+        if opt in ["-j","--jobs"]:
+            try:
+                arg = unicode(arg, enc, "ignore")
+                i = int(arg)
+                if i < 1:
+                    cfg.log("jobs must be >= 1")
+                else:
+                    jobs = i
+            except:
+                cfg.log("%s isn't a valid number of jobs" % arg)
+            else:
+                cfg.log("jobs = %d" % jobs)
+        if opt in ["-p","--parsers"]:
+            try:
+                arg = unicode(arg, enc, "ignore")
+                i = int(arg)
+                if i < 0:
+                    cfg.log("parsers must be >= 0")
+                else:
+                    parsers = i
+            except:
+                cfg.log("%s isn't a valid number of parsers" % arg)
+            else:
+                cfg.log("parsers = %d" % parsers)
+        if opt in ["-e","--engine"]:
+            arg = unicode(arg, enc, "ignore")
+            if arg not in ["threads", "select"]:
+                cfg.log("%s isn't a valid engine" % arg)
+            else:
+                engine = arg
+                cfg.log("engine = %s" % engine)
         if opt in ["-s","--sysfp"]:
             log_func("Using system feedparser")
             global feedparser
@@ -105,13 +165,29 @@ def main(enc):
     # cleaning up when the user has removed a feed from the configuration.
 
     valid_names = [f.URL.replace("/"," ") for f in cfg.feeds]
+    valid_names += [fetch_state_path(n) for n in valid_names] +\
+            [claim_path(n) for n in valid_names] +\
+            [story_state.state_path(n) for n in valid_names] + [RUN_CLAIM]
     for file in os.listdir(cfg.feed_dir):
-        if not file in valid_names:
-            log_func("Deleted extraneous file: %s" % file)
+        if file in valid_names:
+            continue
+
+        # Leave temporary files alone, unless they're too old to be from
+        # anything still running.
+
+        if storage.temporary(file):
             try:
-                os.unlink(cfg.feed_dir + file)
-            except:
-                pass
+                if time.time() - os.stat(cfg.feed_dir + file).st_mtime <\
+                        fetch_claim.LEASE:
+                    continue
+            except OSError:
+                continue
+
+        log_func("Deleted extraneous file: %s" % file)
+        try:
+            os.unlink(cfg.feed_dir + file)
+        except:
+            pass
 
     if background:
         # This is a pretty canonical way to do backgrounding.
@@ -137,38 +213,289 @@ def main(enc):
         os.close(2)
 
     if daemon:
+        # The first pass checks every feed, after that only the feeds that
+        # are due are touched. Between passes, we sleep until the next feed
+        # is due, waking at least every updateInterval to reread the config.
+        #
+        # The parser processes are kept from pass to pass, so that they can be
+        # replaced as they grow (see ParsePool), rather than every pass. The
+        # pool is started before anything else, even if fetch_parsers is 0 for
+        # now, so that its helper is forked before there are any threads.
+        #
+        # If fetch_push_port is set, feeds with a hub are pushed to us as well.
+        # Whatever's pushed is written as soon as it arrives, and those feeds
+        # are otherwise only checked every fetch_push_interval. If a feed is
+        # pushed more than once before we get to it, it's just fetched.
+
+        def parse_pool_size():
+            if parsers == None:
+                return cfg.fetch_parsers
+            return parsers
+
+        parse_pool = ParsePool(parse_pool_size(), log_func,\
+                cfg.fetch_parser_recycle, cfg.fetch_parser_max_mem)
+        schedule = Schedule(updateInterval)
+        conns = fetch_http.ConnectionPool()
+        push = None
         while 1:
-            run(cfg, verbose, force)
-            time.sleep(updateInterval)
+            schedule.sync(cfg.feeds)
+
+            # A reloaded config reaches the running parsers with their next
+            # feed, and run() starts or stops some to match the new size.
+
+            parse_pool.size = parse_pool_size()
+            parse_pool.recycle = cfg.fetch_parser_recycle
+            parse_pool.max_mem = cfg.fetch_parser_max_mem
+
+            push = start_push(cfg, push, log_func)
+
+            pushed = {}
+            if push:
+                push.sync(cfg.feeds)
+                pushed = push.take()
+
+            due = schedule.due()
+            if due or pushed:
+                if due:
+                    run(cfg, verbose, force, jobs, parsers, engine, due,\
+                            schedule, conns, parse_pool=parse_pool, push=push)
+                if pushed:
+                    run(cfg, verbose, True, jobs, parsers, engine,\
+                            pushed.keys(), schedule, conns,\
+                            parse_pool=parse_pool, push=push, pushed=pushed)
+
+            if push:
+                push.subscribe(cfg.fetch_connect_timeout)
+
+            wait = min(schedule.next() - time.time(), updateInterval)
+            if push:
+                push.wait(wait)
+            elif wait > 0:
+                time.sleep(wait)
+
             oldcfg = cfg
             try :
                 cfg = get_cfg(conf_file, log_file, feed_dir, script_dir)
-                self.cfg.parse()
+                cfg.parse()
             except:
                 cfg = oldcfg
     else:
-        sys.exit(run(cfg, verbose, force))
+        sys.exit(run(cfg, verbose, force, jobs, parsers, engine))
+
+# Start the push Receiver if it's wanted, or restart it if its settings have
+# changed, returning the Receiver (or None).
+
+def start_push(cfg, push, log_func):
+    settings = (cfg.fetch_push_address, cfg.fetch_push_port,\
+            cfg.fetch_push_callback)
+    if push and push.settings == settings:
+        return push
+    if push:
+        push.close()
+    if not cfg.fetch_push_port:
+        return None
+
+    try:
+        push = fetch_push.Receiver(cfg.fetch_push_address,\
+                cfg.fetch_push_port, cfg.fetch_push_callback, log_func)
+    except Exception, e:
+        log_func("Couldn't listen for pushes on port %d : %s" %\
+                (cfg.fetch_push_port, e))
+        return None
+
+    push.settings = settings
+    log_func("Listening for pushes at %s" % push.callback)
+    return push
+
+# Schedule is a priority queue of feed URLs, keyed on the time each feed is
+# next due to be checked. The times are only kept in memory, so the daemon's
+# first pass has to check every feed. Feeds that fail are retried after `retry`
+# seconds.
+#
+# Entries aren't removed from the heap when a feed is rescheduled or dropped
+# from the config, they're just ignored if they don't match self.times.
+
+class Schedule():
+    def __init__(self, retry):
+        self.retry = retry
+        self.heap = []
+        self.times = {}
+
+    def set(self, URL, t):
+        self.times[URL] = t
+        heapq.heappush(self.heap, (t, URL))
+
+    # Add any new feeds, due immediately, and forget any that are gone.
+
+    def sync(self, feeds):
+        URLs = [ fd.URL for fd in feeds ]
+        for URL in URLs:
+            if URL not in self.times:
+                self.set(URL, 0)
+        for URL in self.times.keys():
+            if URL not in URLs:
+                del self.times[URL]
+
+    # Pop the URLs of all of the feeds that are due.
+
+    def due(self):
+        now = time.time()
+        r = []
+        while self.heap and self.heap[0][0] <= now:
+            t, URL = heapq.heappop(self.heap)
+            if self.times.get(URL) == t:
+                del self.times[URL]
+                r.append(URL)
+        return r
+
+    # The time the next feed is due.
+
+    def next(self):
+        while self.heap and self.times.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        if self.heap:
+            return self.heap[0][0]
+        return time.time() + self.retry
+
+    # Reschedule a feed once its FetchThread is done.
+
+    def update(self, ft):
+        if ft.next_due:
+            self.set(ft.fd.URL, ft.next_due)
+        else:
+            self.set(ft.fd.URL, time.time() + self.retry)
 
-def run(cfg, verbose=False, force=False):
+# run() updates every feed in the config, or just those whose URLs are in
+# `feeds`. If a Schedule is given, each feed is rescheduled once it's done. If a
+# ConnectionPool is given, its connections are left open for the next run.
+#
+# If fetch_deadline is set, run() returns after that many seconds whether or not
+# every feed is done. Any feeds that aren't are abandoned, and their fetches are
+# cut off.
+#
+# Feeds with any of the tags in `first`, or whose URL is in it, are started
+# before the rest.
+#
+# If a ParsePool is given, it's used instead of starting one for this run, and
+# left running afterwards.
+#
+# If a push Receiver is given, the feeds' hubs are offered to it. Feeds whose
+# URLs are in `pushed` are written from the (data, headers, url) pushed for them
+# instead of being fetched, or fetched straight away if that's None.
+#
+# If another canto-fetch is already running, a normal run leaves it to it. A
+# forced run, or one that's `wait`ing (i.e. for canto, which needs the feeds on
+# disk before it can go on), goes ahead but skips the feeds the other process is
+# updating, and then waits for it to finish them.
 
-    # If we don't explicitly set this, feedparser/urllib will take *forever* to
-    # give up on a connection. 30 is a pretty sane default, I think, considering
-    # that 30 seconds is more than enough time to get your average 4-5k feed
-    # even on a really poor connection.
+def run(cfg, verbose=False, force=False, jobs=None, parsers=None,\
+        engine=None, feeds=None, schedule=None, conns=None, first=None,\
+        wait=False, parse_pool=None, push=None, pushed=None):
 
-    socket.setdefaulttimeout(30)
+    if cfg.fetch_deadline:
+        deadline = time.time() + cfg.fetch_deadline
+    else:
+        deadline = None
 
-    threads = []
+    # Jobs, parsers and engine given on the command line override the
+    # configuration.
+
+    if not jobs:
+        jobs = cfg.fetch_workers
+    if parsers == None:
+        parsers = cfg.fetch_parsers
+    if not engine:
+        engine = cfg.fetch_engine
+    if pushed == None:
+        pushed = {}
 
     def log_func(x):
         if verbose:
             print x
         cfg.log(x)
 
-    def imdone():
-        for thread in threads:
-            thread.join()
-        socket.setdefaulttimeout(None)
+    run_claim = fetch_claim.Claim(cfg.feed_dir + RUN_CLAIM)
+    holder = run_claim.acquire()
+    if holder:
+        if not (force or wait):
+            log_func("Canto-fetch is already running (process %d), skipping" %\
+                    holder)
+            if schedule:
+                for fd in cfg.feeds:
+                    if feeds == None or fd.URL in feeds:
+                        schedule.set(fd.URL, time.time() + schedule.retry)
+            return 0
+        log_func("Canto-fetch is also running (process %d)" % holder)
+
+    # Our own ParsePool has to be started before any of the fetching threads
+    # are, so that its helper is forked without them. A given one already has
+    # its helper.
+
+    if parse_pool:
+        own_parse_pool = False
+        parse_pool.log_func = log_func
+        parse_pool.refill()
+    elif parsers:
+        own_parse_pool = True
+        parse_pool = ParsePool(parsers, log_func, cfg.fetch_parser_recycle,\
+                cfg.fetch_parser_max_mem)
+
+    pool = FetchPool(jobs, cfg.fetch_host_workers, cfg.fetch_script_workers,\
+            log_func, run_claim)
+
+    if conns:
+        own_conns = False
+    else:
+        conns = fetch_http.ConnectionPool()
+        own_conns = True
+    conns.timeout = cfg.fetch_keepalive
+    conns.size = cfg.fetch_pool_size
+
+    resolver = conns.resolver
+    resolver.ttl = cfg.fetch_dns_ttl
+    resolver.negative_ttl = cfg.fetch_dns_negative_ttl
+    resolver.expire()
+
+    fts = []
+
+    def imdone(deadline=None, abandoned=[], waiting=False):
+        abandoned = abandoned + pool.join(deadline)
+        for ft in abandoned:
+            log_func("Abandoned %s, it didn't finish in time" % ft.fd.URL)
+
+        # Any parser processes still busy are working for abandoned feeds.
+        if parse_pool and own_parse_pool:
+            parse_pool.stop(abandoned != [])
+        elif parse_pool and abandoned:
+            parse_pool.close(True)
+
+        # Abandoned fetches were cut off at the deadline too, give them a
+        # moment to wind down.
+        if abandoned:
+            pool.settle(1)
+
+        # Let go of our claims. If we're waiting, the feeds another process
+        # had claimed have to be written first.
+
+        for ft in fts:
+            if waiting and ft.claimed_by:
+                log_func("Waiting for process %d to update %s" %\
+                        (ft.claimed_by, ft.fd.URL))
+                if ft.claim.acquire(True, deadline):
+                    log_func("Gave up waiting for %s" % ft.fd.URL)
+            ft.release()
+        run_claim.release()
+
+        reused, opened = conns.stats()
+        if reused or opened:
+            log_func("%d requests reused a connection, %d opened a new one"\
+                    % (reused, opened))
+        cached, resolved = resolver.stats()
+        if cached or resolved:
+            log_func("%d lookups were cached, %d went to the resolver"\
+                    % (cached, resolved))
+        if own_conns:
+            conns.close()
         log_func("Gracefully exiting Canto-fetch.")
         return 1
 
@@ -179,24 +506,722 @@ def run(cfg, verbose=False, force=False):
 
     # The main canto-fetch loop.
     for fd in cfg.feeds:
+        if feeds != None and fd.URL not in feeds:
+            continue
         fpath = cfg.feed_dir + fd.URL.replace("/", " ")
         spath = cfg.script_dir
-        threads.append(FetchThread(cfg, fd, fpath, spath, force, log_func))
-        threads[-1].start()
+        fts.append(FetchThread(cfg, fd, fpath, spath, force, log_func,\
+                parse_pool, conns, deadline, push, pushed.get(fd.URL)))
+
+    # The order the feeds are started in decides when the last one finishes,
+    # so the ones that have taken longest before go first. Feeds we haven't
+    # timed yet could be anything, so they're treated as the slowest. Feeds
+    # the user is about to look at jump the queue.
+
+    if first:
+        first = [ type(t) == str and unicode(t, "UTF-8", "ignore") or t\
+                for t in first ]
+        if u"*" in first:
+            first = None
+
+    def order(ft):
+        wanted = first and ([ t for t in ft.fd.tags if t in first ] != [] or\
+                ft.fd.URL in first)
+        duration = ft.duration()
+        if duration == None:
+            duration = sys.maxint
+        return (not wanted, -duration)
+
+    fts.sort(key=order)
+
+    # Look up all of the hosts at once, rather than one at a time as each
+    # feed is started.
+
+    if cfg.fetch_dns_prewarm:
+        addresses = []
+        for ft in fts:
+            parts = urlparse.urlsplit(ft.fd.URL)
+            if parts.scheme in ["http", "https"] and parts.hostname:
+                port = parts.port or httplib.HTTP_PORT
+                if parts.scheme == "https":
+                    port = parts.port or httplib.HTTPS_PORT
+                addresses.append((parts.hostname, port))
+        resolver.prewarm(addresses, jobs)
+
+    # The select engine fetches everything, so it's no help with pushes.
+
+    abandoned = []
+    if engine == "select" and not pushed:
+        pool.start()
+        abandoned = fetch_select.SelectEngine(pool, jobs,\
+                cfg.fetch_host_workers, cfg.fetch_connect_timeout,\
+                cfg.fetch_read_timeout, cfg.fetch_max_time, deadline,\
+                resolver, log_func).run(fts)
+    else:
+        for ft in fts:
+            pool.add(ft)
+        pool.close()
+        pool.start()
+
+    imdone(deadline, abandoned, wait)
 
-    imdone()
+    if schedule:
+        for ft in fts:
+            schedule.update(ft)
     return 0
 
+# FetchPool runs FetchThreads with at most `workers` going at once, and at most
+# `host_workers` of those talking to any one host. Rather than starting a thread
+# per feed, each worker thread repeatedly takes the first queued FetchThread
+# whose host isn't busy and calls its run() directly. Script feeds are treated
+# as if they were all on one host, SCRIPTS, that allows `script_workers` at
+# once. FetchThreads that have already been fetched by another engine and just
+# need processing are only bound by the global limit.
+#
+# FetchThreads can be added until close() is called, after which the workers
+# exit as soon as the queue is empty.
+#
+# The workers are daemon threads, so that ones still going after join() has
+# given up on them can't keep canto-fetch from exiting.
+
+SCRIPTS = "script:"
+
+class FetchPool():
+    def __init__(self, workers, host_workers, script_workers, log_func,\
+            claim=None):
+        self.workers = workers
+        self.host_workers = host_workers
+        self.script_workers = script_workers
+        self.log_func = log_func
+
+        # The run's Claim, renewed as each feed is done.
+        self.claim = claim
+
+        self.queue = []
+        self.running = []
+        self.hosts = {}
+        self.cond = Condition()
+        self.threads = []
+        self.closed = False
+
+    def host(self, ft):
+        if ft.fetched:
+            return None
+        if ft.fd.URL.startswith("script:"):
+            return SCRIPTS
+        return urlparse.urlparse(ft.fd.URL).hostname
+
+    def limit(self, h):
+        if h == SCRIPTS:
+            return self.script_workers
+        return self.host_workers
+
+    def add(self, ft):
+        self.cond.acquire()
+        self.queue.append(ft)
+        self.cond.notify()
+        self.cond.release()
+
+    def next(self):
+        self.cond.acquire()
+        try:
+            while self.queue or not self.closed:
+                for ft in self.queue:
+                    h = self.host(ft)
+                    if h == None or self.hosts.get(h, 0) < self.limit(h):
+                        self.queue.remove(ft)
+                        self.running.append(ft)
+                        self.hosts[h] = self.hosts.get(h, 0) + 1
+                        return (ft, h)
+
+                # Everything left is waiting on a busy host, or
+                # there's nothing queued yet.
+                self.cond.wait()
+            return (None, None)
+        finally:
+            self.cond.release()
+
+    def done(self, ft, h):
+        self.cond.acquire()
+        self.running.remove(ft)
+        self.hosts[h] -= 1
+        self.cond.notify_all()
+        self.cond.release()
+
+    def work(self):
+        while True:
+            ft, h = self.next()
+            if not ft:
+                return
+            try:
+                ft.run()
+            except:
+                self.log_func("Exception updating %s : %s" %\
+                        (ft.fd.URL, traceback.format_exc()))
+            ft.release()
+            if self.claim:
+                self.claim.renew()
+            self.done(ft, h)
+
+    def close(self):
+        self.cond.acquire()
+        self.closed = True
+        self.cond.notify_all()
+        self.cond.release()
+
+    def start(self):
+        if self.closed:
+            workers = min(self.workers, len(self.queue))
+        else:
+            workers = self.workers
+
+        for i in xrange(workers):
+            self.threads.append(Thread(target = self.work))
+            self.threads[-1].daemon = True
+            self.threads[-1].start()
+
+    # Wait for the workers to finish, or until the deadline, if there is one.
+    # Anything still queued or running then is abandoned, and returned.
+
+    def join(self, deadline=None):
+        self.close()
+        for thread in self.threads:
+            if deadline:
+                thread.join(max(deadline - time.time(), 0))
+            else:
+                thread.join()
+
+        self.cond.acquire()
+        abandoned = self.queue + self.running
+        self.queue = []
+        for ft in abandoned:
+            ft.abandoned = True
+        self.cond.release()
+        return abandoned
+
+    # Wait up to `seconds` for any workers still going.
+
+    def settle(self, seconds):
+        end = time.time() + seconds
+        for thread in self.threads:
+            thread.join(max(end - time.time(), 0))
+
+# fingerprint hashes everything feedparser gave us for an entry (including its
+# id and updated date), before any of it has been processed.
+
+def fingerprint(entry):
+    h = hashlib.sha1()
+
+    def walk(obj):
+        if isinstance(obj, dict):
+            h.update("{")
+            for k in sorted(obj.keys()):
+                if k != "_deferred":
+                    h.update(repr(k))
+                    walk(obj[k])
+            h.update("}")
+        elif type(obj) in [list, tuple]:
+            h.update("[")
+            for v in obj:
+                walk(v)
+            h.update("]")
+        else:
+            h.update(repr(obj))
+
+    walk(entry)
+    return h.hexdigest()
+
+# parse_feed turns the raw data fetched for a feed into a feedparser dict that's
+# ready to be merged. The headers are the raw HTTP headers (None for script
+# feeds), which feedparser uses to figure out encodings and relative links.
+#
+# Most of the time, most of the entries in a feed are exactly the same as they
+# were last time. `known` is a list of the fingerprints of the entries we
+# already have, and instead of being processed any entry with one of those
+# fingerprints is replaced with a stub, {"canto_fp" : fingerprint}, to be
+# swapped for the stored copy later.
+
+def parse_feed(data, headers, url, max_entries=0, known=None):
+    if headers == None:
+        f = StringIO(data)
+    else:
+        f = urllib.addinfourl(StringIO(data),\
+                httplib.HTTPMessage(StringIO(headers)), url)
+
+    # Only the builtin feedparser can stop early, or put off processing the
+    # markup in entries.
+
+    if feedparser == feedparser_builtin:
+        newfeed = feedparser.parse(f, max_entries=max_entries,\
+                defer_html=1)
+    else:
+        newfeed = feedparser.parse(f)
+
+    if known:
+        known = dict([ (fp, True) for fp in known ])
+    else:
+        known = {}
+
+    # Feedparser's exception objects are often un-Picklable, and we're only
+    # going to log them anyway.
+
+    if "bozo_exception" in newfeed:
+        try:
+            newfeed["bozo_exception"] = u"%s" % newfeed["bozo_exception"]
+        except:
+            newfeed["bozo_exception"] = repr(newfeed["bozo_exception"])
+
+    # For all content that we would usually use, we escape all of the
+    # slashes and other potential escapes.
+
+    def escape(s):
+        s = s.replace("\\","\\\\")
+        return s.replace("%", "\\%")
+
+    for key in newfeed["feed"]:
+        if type(newfeed["feed"][key]) in [unicode,str]:
+            newfeed["feed"][key] = escape(newfeed["feed"][key])
+
+    entries = []
+    for entry in newfeed["entries"]:
+        fp = fingerprint(entry)
+        if fp in known:
+            entries.append({"canto_fp" : fp})
+            continue
+
+        if "_deferred" in entry:
+            feedparser_builtin.finish_entry(entry)
+        entry["canto_fp"] = fp
+        entries.append(entry)
+
+        for subitem in ["content","enclosures"]:
+            if subitem in entry:
+                for e in entry[subitem]:
+                    for k in e.keys():
+                        if type(e[k]) in [unicode,str]:
+                            e[k] = escape(e[k])
+
+        for key in entry.keys():
+            if type(entry[key]) in [unicode,str]:
+                entry[key] = escape(entry[key])
+
+        # If the item didn't come with a GUID, then
+        # use link and then title as an identifier.
+
+        if not "id" in entry:
+            if "link" in entry:
+                entry["id"] = entry["link"]
+            elif "title" in entry:
+                entry["id"] = entry["title"]
+            else:
+                entry["id"] = None
+
+    newfeed["entries"] = entries
+    return newfeed
+
+# Parsing is pure Python and CPU bound, so with a lot of feeds the fetching
+# threads spend most of their time waiting on the GIL. ParsePool forks a number
+# of parser processes up front and the fetching threads hand their raw data to
+# an idle one, blocking until the parsed feed comes back.
+#
+# Like the ProcessHandler in process.py, this just uses a pair of pipes per
+# process, passing length prefixed pickles back and forth.
+#
+# Forking while other threads are running can leave the child with locks that
+# nobody will ever release, and by the time a parser needs replacing, the push
+# Receiver's threads, or fetching threads abandoned by the last run, may well
+# be. So the pool first forks a helper, before any threads are started, and the
+# helper forks the parsers from then on. A parser can't inherit pipes from us
+# that way, so each one gets a pair of named pipes (FIFOs) that we both open,
+# and that are removed as soon as we have.
+#
+# Parsing big feeds fragments the heap, so a parser process only ever grows. If
+# `recycle` is set, each one asks to be retired after parsing that many feeds,
+# and if `max_mem` is set, once it's grown by that many MB since it was forked.
+# The limits are sent along with each feed, so they can be changed on a running
+# pool. Either way, it's replaced by refill(), between runs. Until then the
+# parser carries on.
+
+def pipe_send(fd, obj):
+    s = cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+    s = "%d %s" % (len(s), s)
+    written = 0
+    while written < len(s):
+        written += os.write(fd, buffer(s, written))
+
+def pipe_recv(fd):
+    l = ""
+    while not l.endswith(" "):
+        c = os.read(fd, 1)
+        if not c:
+            raise EOFError
+        l += c
+    l = int(l)
+
+    chunks = []
+    while l:
+        c = os.read(fd, min(l, 65536))
+        if not c:
+            raise EOFError
+        chunks.append(c)
+        l -= len(c)
+    return cPickle.loads("".join(chunks))
+
+# A forked process has no business with any of its parent's other files, or
+# sockets, and shouldn't keep them open.
+
+def close_fds(keep):
+    low = 3
+    for fd in sorted(keep):
+        os.closerange(low, fd)
+        low = fd + 1
+    os.closerange(low, subprocess.MAXFD)
+
+# How much memory this process is using, in MB. A forked process starts off with
+# its parent's, so it's only worth comparing with what it was using when it
+# started. That's its resident set where /proc has it. Elsewhere, it's the
+# high-water mark, which is inherited as well.
+
+def memory_used():
+    try:
+        f = open("/proc/self/statm")
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * resource.getpagesize() / (1024 * 1024)
+    except:
+        # ru_maxrss is in KB.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+class ParsePool():
+    def __init__(self, procs, log_func, recycle=0, max_mem=0):
+        self.size = procs
+        self.log_func = log_func
+        self.recycle = recycle
+        self.max_mem = max_mem
+        self.procs = []
+        self.idle = []
+        self.busy = []
+        self.retired = []
+        self.cond = Condition()
+
+        cmdr, cmdw = os.pipe()
+        pidr, pidw = os.pipe()
+        pid = os.fork()
+        if not pid:
+            close_fds([cmdr, pidw])
+            self.helper(cmdr, pidw)
+
+        os.close(cmdr)
+        os.close(pidw)
+        self.helper_proc = (pid, cmdw, pidr)
+
+        self.refill()
+
+    # Replace the parser processes that have asked to be retired, and start or
+    # stop some until there are `size` of them. Only call this from the main
+    # thread, between runs. A retired process that's still busy (say, with a
+    # feed abandoned by the last run) is left until the next time.
+
+    def refill(self):
+        self.cond.acquire()
+        try:
+            retired = self.retired
+            self.retired = []
+            for proc in retired:
+                if proc not in self.procs:
+                    continue
+                if proc in self.idle:
+                    self.procs.remove(proc)
+                    self.idle.remove(proc)
+                    self.reap(proc)
+                else:
+                    self.retired.append(proc)
+
+            while len(self.procs) > self.size and self.idle:
+                proc = self.idle.pop()
+                self.procs.remove(proc)
+                if proc in self.retired:
+                    self.retired.remove(proc)
+                self.reap(proc)
+
+            while len(self.procs) < self.size:
+                self.spawn()
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    # The helper is told where a new parser's FIFOs are, forks it, and answers
+    # with its PID. It ignores SIGCHLD, so the parsers are reaped as they exit.
+
+    def helper(self, cmdr, pidw):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+
+        while True:
+            try:
+                jobpath, respath = pipe_recv(cmdr)
+            except:
+                # Parent is done with us.
+                os._exit(0)
+
+            try:
+                pid = os.fork()
+            except:
+                pid = None
+
+            if pid == 0:
+                os.close(cmdr)
+                os.close(pidw)
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                self.child(os.open(jobpath, os.O_RDONLY),\
+                        os.open(respath, os.O_WRONLY))
+
+            try:
+                pipe_send(pidw, pid)
+            except:
+                os._exit(0)
+
+    # Must be called with the lock held.
+
+    def spawn(self):
+        helper, cmdw, pidr = self.helper_proc
+        d = tempfile.mkdtemp(prefix="canto-fetch-")
+        jobpath = os.path.join(d, "job")
+        respath = os.path.join(d, "result")
+        try:
+            os.mkfifo(jobpath, 0600)
+            os.mkfifo(respath, 0600)
+
+            pipe_send(cmdw, (jobpath, respath))
+            pid = pipe_recv(pidr)
+            if pid == None:
+                raise Exception, "Couldn't start a parser process"
+
+            # Opening a FIFO blocks until the other end is opened too, and the
+            # parser opens them in the same order.
+
+            jobw = os.open(jobpath, os.O_WRONLY)
+            resr = os.open(respath, os.O_RDONLY)
+        finally:
+            for path in [jobpath, respath]:
+                if os.path.exists(path):
+                    os.unlink(path)
+            os.rmdir(d)
+
+        self.procs.append((pid, jobw, resr))
+        self.idle.append(self.procs[-1])
+
+    def child(self, jobr, resw):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+        jobs = 0
+        start_mem = memory_used()
+        while True:
+            try:
+                recycle, max_mem, job = pipe_recv(jobr)
+            except:
+                # Parent is done with us.
+                os._exit(0)
+
+            try:
+                r = [True, parse_feed(*job), False]
+            except:
+                r = [False, traceback.format_exc(), False]
+            jobs += 1
+
+            if (recycle and jobs >= recycle) or (max_mem and\
+                    memory_used() - start_mem >= max_mem):
+                r[2] = True
+
+            pipe_send(resw, r)
+
+    def parse(self, data, headers, url, max_entries=0, known=None):
+        self.cond.acquire()
+        while not self.idle and self.procs:
+            self.cond.wait()
+
+        # All of the parser processes have died, so just do it ourselves.
+
+        if not self.procs:
+            self.cond.release()
+            return parse_feed(data, headers, url, max_entries, known)
+
+        proc = self.idle.pop(0)
+        self.busy.append(proc)
+        self.cond.release()
+
+        try:
+            pipe_send(proc[1], (self.recycle, self.max_mem,\
+                    (data, headers, url, max_entries, known)))
+            ok, r, retired = pipe_recv(proc[2])
+        except:
+            # If the pool was closed under us, the process isn't ours to clean
+            # up anymore. close() is waiting for us to let go of it.
+
+            self.cond.acquire()
+            try:
+                self.busy.remove(proc)
+                dead = proc in self.procs
+                if dead:
+                    self.procs.remove(proc)
+                self.cond.notify_all()
+            finally:
+                self.cond.release()
+
+            if dead:
+                self.log_func("Parser process %d died" % proc[0])
+                self.reap(proc)
+            raise
+
+        self.cond.acquire()
+        try:
+            self.busy.remove(proc)
+            if proc in self.procs:
+                self.idle.append(proc)
+                if retired and proc not in self.retired:
+                    self.retired.append(proc)
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+        if not ok:
+            raise Exception, r
+        return r
+
+    # The parsers are the helper's children, not ours, so it reaps them.
+
+    def reap(self, proc):
+        pid, jobw, resr = proc
+        os.close(jobw)
+        os.close(resr)
+
+    # If `kill` is set, the parser processes are killed rather than left to
+    # finish what they're doing. Either way, the pipes of a busy one aren't
+    # closed until the thread using it has given up on it, so that thread never
+    # reads from a closed (or reused) file descriptor.
+
+    def close(self, kill=False):
+        self.cond.acquire()
+        try:
+            procs = self.procs
+            self.procs = []
+            self.idle = []
+            self.retired = []
+
+            if kill:
+                for proc in procs:
+                    try:
+                        os.kill(proc[0], signal.SIGKILL)
+                    except:
+                        pass
+
+            while [ p for p in procs if p in self.busy ]:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+
+        for proc in procs:
+            self.reap(proc)
+
+    # Close the pool for good, helper and all.
+
+    def stop(self, kill=False):
+        self.close(kill)
+        pid, cmdw, pidr = self.helper_proc
+        os.close(cmdw)
+        os.close(pidr)
+        try:
+            os.waitpid(pid, 0)
+        except:
+            pass
+
+# Canto-fetch's own bookkeeping for a feed (currently the HTTP validators and the
+# last time the server was checked) is kept in a small pickle beside the feed
+# file. This way a "304 Not Modified" can be recorded without rewriting the
+# whole feed. No URL starts with a dot, so these never collide with feed files.
+
+def fetch_state_path(fpath):
+    head, tail = os.path.split(fpath)
+    return os.path.join(head, "." + tail + ".fetch")
+
+# While a feed is being updated, it's claimed (see fetch_claim.py) with another
+# file beside it. The run as a whole is claimed with RUN_CLAIM.
+
+def claim_path(fpath):
+    head, tail = os.path.split(fpath)
+    return os.path.join(head, "." + tail + ".claim")
+
+RUN_CLAIM = ".canto-fetch.claim"
+
+# How many of a feed's latest fetch times are averaged to guess how long its
+# next one will take.
+
+DURATIONS = 5
+
+# FetchThread is no longer started by itself, FetchPool workers call run().
+
 class FetchThread(Thread):
-    def __init__(self, cfg, fd, fpath, spath, force, log_func):
+    def __init__(self, cfg, fd, fpath, spath, force, log_func,\
+            parse_pool=None, conns=None, deadline=None, push=None,\
+            pushed=None):
         Thread.__init__(self)
         self.fd = fd
         self.fpath = fpath
+        self.statepath = fetch_state_path(fpath)
+        self.story_state_path = story_state.state_path(fpath)
         self.spath = spath
         self.force = force
         self.cfg = cfg
         self.log_func = log_func
-        self.prevtime = 0
+        self.parse_pool = parse_pool
+
+        # The generation of the feed file we read (see storage.py).
+        self.generation = 0
+
+        # The ConnectionPool for HTTP requests.
+        if conns:
+            self.conns = conns
+        else:
+            self.conns = fetch_http.ConnectionPool(0)
+
+        # The (data, headers, url) of the feed, once it's been fetched, and
+        # whether the data was cut off at the feed's max_size.
+        self.fetched = None
+        self.truncated = False
+
+        # When this feed should next be checked, if we got far enough to know.
+        # The daemon's Schedule uses this, None means the update failed.
+        self.next_due = None
+
+        # The time by which the whole run has to be done, if any, and whether
+        # the run has given up on this feed.
+        self.deadline = deadline
+        self.abandoned = False
+
+        # How long has been spent fetching the feed, and when processing it
+        # started. These are recorded in the fetch state once it's done.
+        self.elapsed = 0
+        self.process_start = None
+
+        # Our claim on the feed, and the PID of the process that had it if we
+        # couldn't get it.
+        self.claim = fetch_claim.Claim(claim_path(fpath))
+        self.claimed_by = None
+
+        # Where the feed is fetched from, where it turned out to have moved
+        # to for good, and the authentication scheme that worked.
+        self.url = fd.URL
+        self.moved = None
+        self.auth = None
+
+        # The push Receiver, and the (data, headers, url) that was pushed to
+        # it for this feed. Pushed content may only be the newest items.
+        self.push = push
+        self.pushed = pushed
 
         # This emptyfeed forms a skeleton for any canto feed.
         # Canto_state is a place holder. Canto_update is the
@@ -209,27 +1234,22 @@ class FetchThread(Thread):
         self.emptyfeed = {"canto_state":[], "entries":[], "canto_update":0,
                         "canto_version": VERSION_TUPLE }
 
-    # get_curfeed loads the old feed data from disk. It blocks getting the lock,
-    # so it could take awhile, but should never fail if the information isn't
-    # corrupted.
+    # get_curfeed loads the old feed data from disk, along with the state of
+    # each story, and remembers its generation (see storage.py). It should
+    # never fail if the information isn't corrupted.
 
     def get_curfeed(self):
-        curfeed = self.emptyfeed
-        if os.path.exists(self.fpath):
-            if os.path.isfile(self.fpath):
-                f = open(self.fpath, "r")
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        curfeed = None
+        try:
+            self.generation, curfeed = storage.load(self.fpath)
+        except:
+            self.log_func("cPickle load exception on %s" % self.fpath)
+            self.generation = storage.generation(self.fpath)
 
-                self.prevtime = os.stat(self.fpath).st_mtime
+        if not curfeed:
+            curfeed = self.emptyfeed
 
-                try:
-                    curfeed = cPickle.load(f)
-                except:
-                    self.log_func("cPickle load exception on %s" % self.fpath)
-                finally:
-                    fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                    f.close()
-        else:
+        if not os.path.exists(self.fpath):
 
             # The file doesn't exist yet, so we write a stub so that Canto
             # detects presence and doesn't endlessly try to refetch error'd
@@ -244,35 +1264,184 @@ class FetchThread(Thread):
                 }
 
             curfeed["entries"].append(d)
-            f = open(self.fpath, "w")
             try:
-                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
-                cPickle.dump(curfeed, f)
-                f.flush()
+                generation = storage.save(self.fpath, curfeed,\
+                        self.generation, True, self.cfg.fetch_compress_level)
+                if generation != None:
+                    self.generation = generation
             except:
                 pass
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
 
+        story_state.attach(self.story_state_path, curfeed["entries"],\
+                self.fd.tags + [u"*"])
+
+        # Files written in an older storage FORMAT are written again in the
+        # current one straight away, so canto doesn't have to convert them
+        # every time it reads them, and so are files that are compressed when
+        # fetch_compress_level says they shouldn't be, or the other way round.
+        # The state has been moved out of them by now.
+
+        header = storage.header(self.fpath)
+        if curfeed is not self.emptyfeed and (header[1] < storage.FORMAT or\
+                bool(header[3]) != bool(self.cfg.fetch_compress_level)):
+            content = copy.copy(curfeed)
+            content["entries"] = [ story_state.strip(e)\
+                    for e in curfeed["entries"] ]
+            try:
+                generation = storage.save(self.fpath, content,\
+                        self.generation, True, self.cfg.fetch_compress_level)
+                if generation != None:
+                    self.generation = generation
+                    self.log_func("Migrated %s" % self.fpath)
+            except:
+                self.log_func("cPickle dump exception on %s" % self.fpath)
         return curfeed
 
-    def run(self):
-        curfeed = self.get_curfeed()
+    # get_fetch_state / set_fetch_state read and write the fetch bookkeeping
+    # pickle. Losing it is harmless (we just do an unconditional fetch), so
+    # errors are logged and otherwise ignored.
+
+    def get_fetch_state(self):
+        try:
+            return storage.load(self.statepath)[1] or {}
+        except:
+            self.log_func("cPickle load exception on %s" % self.statepath)
+            return {}
+
+    def set_fetch_state(self, fstate):
+        try:
+            storage.save(self.statepath, fstate)
+        except:
+            self.log_func("cPickle dump exception on %s" % self.statepath)
+
+    # The time by which this fetch has to be done, if any.
+
+    def fetch_deadline(self):
+        deadline = self.deadline
+        if self.cfg.fetch_max_time:
+            deadline = min(deadline or sys.maxint,\
+                    time.time() + self.cfg.fetch_max_time)
+        return deadline
+
+    # The average time this feed has taken lately, or None if it's never been
+    # timed.
+
+    def duration(self):
+        durations = self.get_fetch_state().get("durations")
+        if not durations:
+            return None
+        return sum(durations) / len(durations)
+
+    # Open a request for the feed, with authentication if the feed is
+    # configured for it. Whichever of Basic and Digest authentication worked
+    # last time is tried first, and if it was Basic the credentials are sent
+    # straight away instead of waiting for the server to ask for them.
+
+    def open_request(self, deadline=None):
+        timeout = self.cfg.fetch_connect_timeout
+
+        def attempt(request, *auth):
+            moved = fetch_http.MovedHandler()
+            handlers = list(auth) + fetch_http.pool_handlers(self.conns,\
+                    self.cfg.fetch_read_timeout, deadline)
+            try:
+                return urllib2.build_opener(moved, *handlers).open(request,\
+                        timeout=timeout)
+            finally:
+                self.moved = moved.moved
+
+        if not (self.fd.username or self.fd.password):
+            return attempt(self.request())
+
+        # The password only ever goes to the host in the config, even if the
+        # feed has moved, or redirects somewhere else.
+
+        mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
+        domain = urlparse.urlparse(self.fd.URL)[1]
+        mgr.add_password(None, domain, self.fd.username, self.fd.password)
+
+        schemes = ["basic", "digest"]
+        if self.fstate.get("auth") == "digest":
+            schemes.reverse()
+
+        for scheme in schemes:
+            request = self.request()
+            if scheme == "basic":
+                auth = urllib2.HTTPBasicAuthHandler(mgr)
+                if self.fstate.get("auth") == "basic" and\
+                        fetch_http.same_host(self.url, self.fd.URL):
+                    raw = "%s:%s" % (self.fd.username, self.fd.password)
+                    request.add_unredirected_header("Authorization",\
+                            "Basic " + base64.b64encode(raw).strip())
+            else:
+                auth = urllib2.HTTPDigestAuthHandler(mgr)
+
+            try:
+                response = attempt(request, auth)
+            except urllib2.HTTPError, e:
+                # A 304 means authentication worked just fine.
+                if e.code == 304:
+                    self.auth = scheme
+                    raise
+                if scheme == schemes[-1]:
+                    raise
+            except:
+                if scheme == schemes[-1]:
+                    raise
+            else:
+                self.auth = scheme
+                return response
+
+    # prepare loads the feed's current state and decides whether it's due for an
+    # update at all.
+
+    def prepare(self):
+        # The claim has to come first, so that if another process has just
+        # updated the feed, we see that it's not due.
+
+        self.claimed_by = self.claim.acquire()
+        if self.claimed_by:
+            self.log_func("%s is being updated by process %d, skipping" %\
+                    (self.fd.URL, self.claimed_by))
+            return False
+
+        self.curfeed = self.get_curfeed()
+        self.fstate = self.get_fetch_state()
+
+        # If the feed has permanently moved, go straight to where it is now.
+        # Only moves within the same host are remembered.
+
+        if "location" in self.fstate:
+            if self.cfg.fetch_remember_moved and\
+                    fetch_http.same_host(self.fstate["location"], self.fd.URL):
+                self.url = self.fstate["location"]
+            else:
+                del self.fstate["location"]
 
         # Determine whether it's been long enough between
-        # updates to warrant refetching the feed.
+        # updates to warrant refetching the feed. Usually
+        # fetch_rate has already worked that out, otherwise
+        # a server telling us that nothing changed counts as
+        # an update.
 
-        if time.time() - curfeed["canto_update"] < self.fd.rate * 60 and\
-                not self.force:
-            return
+        if "next" in self.fstate:
+            due = self.fstate["next"]
+        else:
+            due = max(self.curfeed["canto_update"],\
+                    self.fstate.get("checked", 0)) + self.fd.rate * 60
+
+        if time.time() < due and not self.force:
+            self.next_due = due
+            self.offer_push()
+            self.release()
+            return False
 
         # Attempt to set the tag, if unspecified, by grabbing
         # it out of the previously downloaded info.
 
         if not self.fd.base_set:
-            if "feed" in curfeed and "title" in curfeed["feed"]:
-                replace = lambda x: x or curfeed["feed"]["title"]
+            if "feed" in self.curfeed and "title" in self.curfeed["feed"]:
+                replace = lambda x: x or self.curfeed["feed"]["title"]
                 self.fd.tags = [ replace(x) for x in self.fd.tags]
                 self.fd.base_set = 1
                 self.log_func("Updating %s" % self.fd.tags[0])
@@ -284,73 +1453,441 @@ class FetchThread(Thread):
         else:
             self.log_func("Updating %s" % self.fd.tags[0])
 
-        # This block set newfeed to a parsed feed.
+        return True
+
+    def request(self):
+        request = urllib2.Request(self.url)
+        request.add_header('User-Agent',\
+            "Canto/%d.%d.%d + http://codezen.org/canto" %\
+            VERSION_TUPLE)
+        request.add_header('Accept-Encoding', 'gzip, deflate')
+
+        # Only make the request conditional if we have real content on
+        # disk, otherwise a stub could stick around forever.
+
+        if self.curfeed["canto_update"]:
+            if "etag" in self.fstate:
+                request.add_header('If-None-Match', self.fstate["etag"])
+            if "modified" in self.fstate:
+                request.add_header('If-Modified-Since',\
+                        self.fstate["modified"])
+
+        return request
+
+    # fetch gets the raw data for the feed, returning (data, headers, url).
+
+    def fetch(self):
+        deadline = self.fetch_deadline()
+
+        # Feed from script
+        if self.fd.URL.startswith("script:"):
+            return (self.run_script(deadline), None, None)
 
+        # Feed from URL
+        response = self.open_request(deadline)
         try:
-            # Feed from script
-            if self.fd.URL.startswith("script:"):
-                script = self.spath + "/" + self.fd.URL[7:]
-                out = commands.getoutput(script)
-                newfeed = feedparser.parse(out)
-            # Feed from URL
+            info = response.info()
+            data = self.read(response, info.getheader("Content-Encoding"),\
+                    deadline)
+            return (data, fetch_http.decoded_headers(info.headers),\
+                    response.geturl())
+        finally:
+            response.close()
+
+    # Script feeds are run in a process group of their own, so that the script
+    # and anything it starts can be killed if it takes longer than
+    # fetch_script_timeout. Its output is read just like a response. The script
+    # is told what we know about the feed through the environment, so it can
+    # only do as much work as it needs to:
+    #
+    # CANTO_URL     - the feed's URL (i.e. "script:myscript -arg")
+    # CANTO_UPDATE  - when the feed was last updated, in seconds since the
+    #                 epoch, or 0 if it never has been
+    # CANTO_CHECKED - when the feed was last checked, the same way
+
+    def run_script(self, deadline=None):
+        script = self.spath + "/" + self.fd.URL[7:]
+
+        env = dict(os.environ)
+        env["CANTO_URL"] = self.fd.URL.encode("UTF-8")
+        env["CANTO_UPDATE"] = "%d" % self.curfeed["canto_update"]
+        env["CANTO_CHECKED"] = "%d" % self.fstate.get("checked", 0)
+
+        timeout = fetch_http.remaining(self.cfg.fetch_script_timeout or None,\
+                deadline)
+
+        errors = tempfile.TemporaryFile()
+        proc = subprocess.Popen(script.encode("UTF-8"), shell=True,\
+                stdout=subprocess.PIPE, stderr=errors, env=env,\
+                close_fds=True, preexec_fn=os.setsid)
+
+        killed = []
+        def kill():
+            killed.append(True)
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+
+        timer = None
+        if timeout:
+            timer = Timer(timeout, kill)
+            timer.daemon = True
+            timer.start()
+
+        try:
+            try:
+                data = self.read(proc.stdout, None, deadline)
+            except:
+                kill()
+                raise
+            finally:
+                # If we stopped reading early, we don't want the rest.
+                if self.truncated:
+                    kill()
+                proc.stdout.close()
+                proc.wait()
+        finally:
+            if timer:
+                timer.cancel()
+
+        if killed and not self.truncated:
+            errors.close()
+            raise Exception, "%s took more than %d seconds, killed" %\
+                    (script, timeout)
+
+        if proc.returncode and not killed:
+            errors.seek(0, 0)
+            msg = errors.read(1024).strip()
+            errors.close()
+            if not data:
+                raise Exception, "%s exited with %d: %s" %\
+                        (script, proc.returncode, msg)
+            self.log_func("%s exited with %d: %s" %\
+                    (script, proc.returncode, msg))
+        else:
+            errors.close()
+
+        return data
+
+    # Read a response a chunk at a time, decompressing it as we go, so that a
+    # huge feed can be cut off at the feed's max_size without holding any more
+    # than that in memory.
+
+    def read(self, response, encoding=None, deadline=None):
+        limit = self.fd.max_size * 1024
+        decoder = fetch_http.Decoder(encoding)
+        chunks = []
+        size = 0
+
+        while 1:
+            if deadline and time.time() > deadline:
+                raise socket.timeout("timed out")
+
+            chunk = response.read(fetch_http.READ_CHUNK)
+            if not chunk:
+                chunks.append(decoder.flush())
+                return "".join(chunks)
+
+            chunk = decoder.decompress(chunk)
+            while chunk:
+                chunks.append(chunk)
+                size += len(chunk)
+                if limit and size > limit:
+                    return self.truncate("".join(chunks))
+                chunk = decoder.more()
+
+    # Cut the data off at max_size. It's cut just after a tag, so that the
+    # parser doesn't choke on half of a multi-byte character.
+
+    def truncate(self, data):
+        data = data[:self.fd.max_size * 1024]
+        data = data[:data.rfind(">") + 1]
+        self.log_func("%s is over %d KB, truncating" %\
+                (self.fd.URL, self.fd.max_size))
+        self.truncated = True
+        return data
+
+    # merge takes the freshly fetched entries and the entries already on disk
+    # and returns the entries to write, along with the list of genuinely new
+    # entries. It's linear, since old entries are looked up by id and entries
+    # are tracked by identity, rather than comparing dicts.
+
+    def merge(self, fetched, current):
+        index = {}
+        for centry in current:
+            index.setdefault(centry["id"], []).append(centry)
+
+        entries = []
+        new = []
+        used = {}
+
+        for entry in fetched:
+            if index.get(entry["id"]):
+                # The matched entry is used up so that later it's not a
+                # candidate for being appended to the end of the feed.
+
+                centry = index[entry["id"]].pop(0)
+                used[id(centry)] = True
+                entry["canto_state"] = centry["canto_state"]
             else:
-                request = urllib2.Request(self.fd.URL)
-                request.add_header('User-Agent',\
-                    "Canto/%d.%d.%d + http://codezen.org/canto" %\
-                    VERSION_TUPLE)
-
-                # Feed from URL w/ password
-                if self.fd.username or self.fd.password:
-                    mgr = urllib2.HTTPPasswordMgrWithDefaultRealm()
-                    domain = urlparse.urlparse(self.fd.URL)[1]
-                    mgr.add_password(None, domain,\
-                            self.fd.username, self.fd.password)
-
-                    # First, we try Basic Authentication
-                    auth = urllib2.HTTPBasicAuthHandler(mgr)
-                    opener = urllib2.build_opener(auth)
-                    try:
-                        newfeed = feedparser.parse(opener.open(request))
-                    except:
-                        # And, failing that, try Digest Authentication
-                        auth = urllib2.HTTPDigestAuthHandler(mgr)
-                        opener = urllib2.build_opener(auth)
-                        newfeed = feedparser.parse(opener.open(request))
-                # Feed with no password.
-                else:
-                    newfeed = feedparser.parse(\
-                            feedparser.urllib2.urlopen(request))
-        except:
-            # Generally an exception is a connection refusal, but in any
-            # case we either won't get data or can't trust the data, so
-            # just skip processing this feed.
+                # Apply default state to genuinely new items.
+                new.append(entry)
+                entry["canto_state"] = self.fd.tags + [u"*"]
+            entries.append(entry)
+
+        old = [ e for e in current if id(e) not in used ]
+
+        # Tailor the list to the correct number of items. In canto < 0.7.0,
+        # you could specify a keep that was lower than the number of items
+        # in the feed. This was simply done, but ultimately it caused too
+        # much "bounce" for social news feeds. Items get put into the feed,
+        # are upvoted enough to be within the first n items, you change
+        # their state, they move out of the first n items, are forgotten,
+        # then are upvoted again into the first n item and (as far as c-f
+        # knows) are treated like brand new items.
+
+        # This will still be a problem if items get taken out of the feed
+        # and put back into the feed (and the item isn't in the extra kept
+        # items), but then it becomes a site problem, not a reader problem.
+
+        kept = {}
+        if self.fd.keep and len(entries) < self.fd.keep:
+            for e in old[:self.fd.keep - len(entries)]:
+                entries.append(e)
+                kept[id(e)] = True
+
+        # Enforce the "never_discard" setting
+        # We iterate through the stories and then the tag so that
+        # feed order is preserved.
+
+        for e in old:
+            if id(e) in kept:
+                continue
+            for tag in self.cfg.never_discard:
+                if tag == "unread":
+                    if "read" in e["canto_state"]:
+                        continue
+                elif tag not in e["canto_state"]:
+                    continue
+                entries.append(e)
+                kept[id(e)] = True
+                break
+
+        return (entries, new)
 
-            enc = locale.getpreferredencoding()
-            self.log_func("Exception trying to get feed %s : %s" % \
-                    (self.fd.URL.encode(enc, "ignore"), sys.exc_info()[1]))
+    # Record how this check went and work out when the next one should be.
+    # The caller has to save the fetch state.
 
+    def reschedule(self, result, headers={}, feed=None, missed=False):
+        if feed == None:
+            feed = self.curfeed.get("feed", {})
+
+        now = time.time()
+
+        duration = self.elapsed
+        if self.process_start:
+            duration += now - self.process_start
+        durations = self.fstate.get("durations", []) + [duration]
+        self.fstate["durations"] = durations[-DURATIONS:]
+
+        # Remember where the feed has moved to and how we got in, if it
+        # worked. If it didn't, the feed's own URL is worth trying again.
+
+        if result == "error":
+            if self.url != self.fd.URL and "location" in self.fstate:
+                del self.fstate["location"]
+        else:
+            if self.moved and self.cfg.fetch_remember_moved and\
+                    self.moved != self.fstate.get("location") and\
+                    fetch_http.same_host(self.moved, self.fd.URL):
+                self.log_func("%s has moved to %s" % (self.fd.URL, self.moved))
+                self.fstate["location"] = self.moved
+            if self.auth:
+                self.fstate["auth"] = self.auth
+
+        # Remember whether the feed has a hub, so the daemon can subscribe to
+        # it even when the feed isn't due.
+
+        if result != "error" and not self.pushed:
+            hub, topic = fetch_push.hub_links(self.url, feed, headers)
+            if hub:
+                self.fstate["hub"] = (hub, topic)
+            elif "hub" in self.fstate:
+                del self.fstate["hub"]
+        self.offer_push()
+
+        fetch_rate.record(self.fstate, result, now)
+        self.fstate["next"] = fetch_rate.next_check(self.fstate, now,\
+                self.fd.rate * 60, self.cfg.fetch_min_rate * 60,\
+                self.cfg.fetch_max_rate * 60, headers, feed, missed)
+        self.next_due = self.fstate["next"]
+
+        # If the feed is being pushed to us, polling is just a safety net. This
+        # isn't saved, since other canto-fetch processes won't get the pushes.
+
+        if self.push and self.push.subscribed(self.fd.URL):
+            self.next_due = max(self.next_due,\
+                    now + self.cfg.fetch_push_interval * 60)
+
+    def offer_push(self):
+        if self.push and not self.fd.URL.startswith("script:"):
+            hub, topic = self.fstate.get("hub", (None, None))
+            self.push.offer(self.fd.URL, hub, topic, self.fd.max_size)
+
+    def release(self):
+        self.claim.release()
+
+    # fetch_error is the end of the line for a feed, so its claim is released
+    # once the state's been saved.
+
+    def fetch_error(self, e):
+        try:
+            self.report_error(e)
+        finally:
+            self.release()
+
+    def report_error(self, e):
+        if isinstance(e, urllib2.HTTPError) and e.code == 304:
+            # Nothing has changed, so there's nothing to parse, merge or
+            # write. Just remember that we checked.
+
+            self.log_func("%s unchanged, skipping" % self.fd.tags[0])
+            if e.info().getheader("ETag"):
+                self.fstate["etag"] = e.info().getheader("ETag")
+            self.fstate["checked"] = time.time()
+            self.reschedule("same", e.info().dict)
+            self.set_fetch_state(self.fstate)
             return
 
-        # I don't know why feedparser doesn't actually throw this
-        # since all URLErrors are basically unrecoverable.
+        # Generally an exception is a connection refusal, but in any
+        # case we either won't get data or can't trust the data, so
+        # just skip processing this feed.
 
-        if "bozo_exception" in newfeed:
-            if type(newfeed["bozo_exception"]) == urllib2.URLError:
-                self.log_func(\
-                    "Feedparser exception getting %s : %s, bailing." %\
-                    (self.fd.URL, newfeed["bozo_exception"].reason))
+        enc = locale.getpreferredencoding()
+        self.log_func("Exception trying to get feed %s : %s" % \
+                (self.fd.URL.encode(enc, "ignore"), e))
+
+        if isinstance(e, urllib2.HTTPError) and e.info():
+            self.reschedule("error", e.info().dict)
+        else:
+            self.reschedule("error")
+        self.set_fetch_state(self.fstate)
+
+    # If another engine has already prepared and fetched this feed, run() just
+    # picks up where it left off.
+
+    def run(self):
+        if not self.fetched:
+            if not self.prepare():
+                return
+
+            if self.pushed:
+                self.fetched = self.pushed
+            else:
+                start = time.time()
+                try:
+                    self.fetched = self.fetch()
+                except:
+                    self.elapsed += time.time() - start
+                    self.fetch_error(sys.exc_info()[1])
+                    return
+                self.elapsed += time.time() - start
+
+        if not self.abandoned:
+            self.process(*self.fetched)
+
+    # process parses the fetched data, merges it with what's on disk and
+    # writes it out.
+
+    def process(self, data, headers, url):
+        self.process_start = time.time()
+        self.claim.renew()
+        curfeed = self.curfeed
+
+        # Plenty of servers ignore conditional requests, but send exactly the
+        # same thing. If so, there's nothing to parse, merge or write, so it's
+        # treated just like a 304.
+
+        digest = hashlib.sha1(data).hexdigest()
+        if curfeed["canto_update"] and self.fstate.get("digest") == digest\
+                and not self.pushed:
+            self.log_func("%s identical, skipping" % self.fd.tags[0])
+            self.fstate["checked"] = time.time()
+            if headers:
+                self.reschedule("same",\
+                        httplib.HTTPMessage(StringIO(headers)).dict)
+            else:
+                self.reschedule("same")
+            self.set_fetch_state(self.fstate)
+            return
+
+        # Parse the data, either here or in a parser process.
+
+        try:
+            # If the feed was too big to read the whole thing, it's too big
+            # to parse the whole thing as well. Only parse enough items to
+            # satisfy keep.
+
+            max_entries = 0
+            if self.truncated:
+                max_entries = self.fd.keep
+
+            # Entries we already have don't need to be processed again.
+
+            stored = {}
+            for centry in curfeed["entries"]:
+                if "canto_fp" in centry:
+                    stored[centry["canto_fp"]] = centry
+
+            if self.parse_pool:
+                newfeed = self.parse_pool.parse(data, headers, url,\
+                        max_entries, stored.keys())
+            else:
+                newfeed = parse_feed(data, headers, url, max_entries,\
+                        stored.keys())
+        except:
+            if self.abandoned:
                 return
+            self.log_func("Exception parsing feed %s : %s" %\
+                    (self.fd.URL, sys.exc_info()[1]))
+            self.reschedule("error")
+            self.set_fetch_state(self.fstate)
+            return
+
+        if "bozo_exception" in newfeed:
             if not len(newfeed["entries"]):
                 self.log_func(\
                     "Feedparser exception, no content in %s : %s, bailing." %\
                     (self.fd.URL, newfeed["bozo_exception"]))
+                self.reschedule("error")
+                self.set_fetch_state(self.fstate)
                 return
 
+        # Fill in the entries that parse_feed skipped with our copies.
+
+        for i, entry in enumerate(newfeed["entries"]):
+            if len(entry) == 1 and "canto_fp" in entry:
+                newfeed["entries"][i] = copy.copy(stored[entry["canto_fp"]])
+
         # Filter out "No Content" message since we apparently have real content
 
         curfeed["entries"] = [ x for x in curfeed["entries"] if x["id"] !=\
                 "canto-internal"]
 
+        # Pushed content doesn't have to include the items that haven't
+        # changed, so the newest of what we already had fill out the rest of
+        # the feed, up to as many items as it had when it was last polled. The
+        # older ones are left to merge(), and `keep` and never_discard, just
+        # like items that have dropped out of a polled feed.
+
+        if self.pushed:
+            ids = dict([ (e["id"], True) for e in newfeed["entries"] ])
+            rest = [ e for e in curfeed["entries"] if e["id"] not in ids ]
+            length = self.fstate.get("length", len(curfeed["entries"]))
+            newfeed["entries"] += rest[:max(length - len(newfeed["entries"]),\
+                    0)]
+
         # For new feeds whose base tag is still not set, attempt to get a title
         # again.
 
@@ -390,148 +1927,151 @@ class FetchThread(Thread):
 
         newfeed["canto_version"] = VERSION_TUPLE
 
-        # For all content that we would usually use, we escape all of the
-        # slashes and other potential escapes.
-
-        def escape(s):
-            s = s.replace("\\","\\\\")
-            return s.replace("%", "\\%")
-
-        for key in newfeed["feed"]:
-            if type(newfeed["feed"][key]) in [unicode,str]:
-                newfeed["feed"][key] = escape(newfeed["feed"][key])
-
-        for entry in newfeed["entries"]:
-            for subitem in ["content","enclosures"]:
-                if subitem in entry:
-                    for e in entry[subitem]:
-                        for k in e.keys():
-                            if type(e[k]) in [unicode,str]:
-                                e[k] = escape(e[k])
-
-            for key in entry.keys():
-                if type(entry[key]) in [unicode,str]:
-                    entry[key] = escape(entry[key])
-
-        for entry in newfeed["entries"]:
-            # If the item didn't come with a GUID, then
-            # use link and then title as an identifier.
-
-            if not "id" in entry:
-                if "link" in entry:
-                    entry["id"] = entry["link"]
-                elif "title" in entry:
-                    entry["id"] = entry["title"]
-                else:
-                    entry["id"] = None
+        # If none of the items we had last time are still in the feed, it's
+        # probably moving faster than we're checking it.
+
+        fetched = newfeed["entries"]
+        had_entries = len(curfeed["entries"]) > 0
 
         # Then search through the current feed to
-        # make item state persistent, and loop until
-        # it's safe to update on disk.
+        # make item state persistent.
 
-        new = []
-        while 1:
-            for entry in newfeed["entries"]:
-                for centry in curfeed["entries"]:
-                    if entry["id"] == centry["id"]:
-                        entry["canto_state"] = centry["canto_state"]
-                        
-                        # The entry is removed so that later it's
-                        # not a candidate for being appended to the
-                        # end of the feed.
-
-                        curfeed["entries"].remove(centry)
-                        break
-                else:
-                    new.append(entry)
+        if self.abandoned:
+            return
 
-                # Apply default state to genuinely new items.
-                if "canto_state" not in entry:
-                    entry["canto_state"] = self.fd.tags + [u"*"]
-
-            # Tailor the list to the correct number of items. In canto < 0.7.0,
-            # you could specify a keep that was lower than the number of items
-            # in the feed. This was simply done, but ultimately it caused too
-            # much "bounce" for social news feeds. Items get put into the feed,
-            # are upvoted enough to be within the first n items, you change
-            # their state, they move out of the first n items, are forgotten,
-            # then are upvoted again into the first n item and (as far as c-f
-            # knows) are treated like brand new items.
-
-            # This will still be a problem if items get taken out of the feed
-            # and put back into the feed (and the item isn't in the extra kept
-            # items), but then it becomes a site problem, not a reader problem.
-
-            if self.fd.keep and len(newfeed["entries"]) < self.fd.keep:
-                newfeed["entries"] += curfeed["entries"]\
-                        [:self.fd.keep - len(newfeed["entries"])]
-
-            # Enforce the "never_discard" setting
-            # We iterate through the stories and then the tag so that
-            # feed order is preserved.
-
-            for e in curfeed["entries"]:
-                for tag in self.cfg.never_discard:
-                    if tag == "unread":
-                        if "read" in e["canto_state"]:
-                            continue
-                    elif tag not in e["canto_state"]:
-                        continue
-                    if e not in newfeed["entries"]:
-                        newfeed["entries"].append(e)
+        newfeed["entries"], new = self.merge(fetched, curfeed["entries"])
 
-            if self.cfg.new_hook:
-                for entry in [e for e in new if e in newfeed["entries"]]:
-                    self.cfg.new_hook(newfeed, entry, entry == new[-1])
+        if self.cfg.new_hook:
+            for entry in new:
+                self.cfg.new_hook(newfeed, entry, entry is new[-1])
 
-            # Dump the output to the new file.
+        # The stories' state is written first, so that canto never finds a
+        # story without it. Whatever canto has changed since we read it is
+        # kept, we only add the new stories and drop the ones that are gone.
+        # The state isn't written to the feed file.
 
-            # Locking and writing is counter-intuitive using fcntl. If you open
-            # with "w" and fail to get the lock, the data is still deleted. The
-            # solution is to open with "a", get the lock and then truncate the
-            # file.
+        entries = newfeed["entries"]
+        story_state.update(self.story_state_path, lambda states:\
+                dict([ (e["id"], states.get(e["id"], e["canto_state"]))\
+                for e in entries ]))
 
-            f = open(self.fpath, "a")
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        content = copy.copy(newfeed)
+        content["entries"] = [ story_state.strip(e) for e in entries ]
 
-            # The feed was modified out from under us.
-            if self.prevtime and self.prevtime != os.stat(self.fpath).st_mtime:
-                # Unlock.
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+        # Dump the output to the new file, unless the feed has been written
+        # since we read it. Our claim on the feed should make sure it hasn't,
+        # unless we took so long that the claim was taken over.
 
-                # Reread the state from disk.
-                newer_curfeed = self.get_curfeed()
+        try:
+            generation = storage.save(self.fpath, content, self.generation,\
+                    True, self.cfg.fetch_compress_level)
+        except:
+            self.log_func("cPickle dump exception on %s" % self.fpath)
+            self.reschedule("error")
+            self.set_fetch_state(self.fstate)
+            return
 
-                # There was an actual c-f update done, bail.
-                if newer_curfeed["canto_update"] != curfeed["canto_update"]:
-                    self.log_func("%s updated already, bailing" %
-                            self.fd.tags[0])
-                    break
+        if generation == None:
+            self.log_func("%s updated already, bailing" % self.fd.tags[0])
+            self.next_due = self.get_fetch_state().get("next")
+            return
+        self.generation = generation
+
+        # Save the validators for the next request, if the server gave us any,
+        # now that the content they describe is on disk. Pushes don't tell us
+        # anything about the feed itself.
+
+        fstate = self.fstate
+        if not self.pushed:
+            fstate["checked"] = newfeed["canto_update"]
+            fstate["digest"] = digest
+            fstate["length"] = len(fetched)
+            for key in ["etag", "modified"]:
+                if key in fstate:
+                    del fstate[key]
+
+            if "etag" in newfeed and newfeed["etag"]:
+                fstate["etag"] = newfeed["etag"]
+            if "headers" in newfeed and "last-modified" in newfeed["headers"]:
+                fstate["modified"] = newfeed["headers"]["last-modified"]
+
+        if new:
+            missed = had_entries and len(new) == len(fetched)
+            self.reschedule("new", newfeed.get("headers", {}),\
+                    newfeed["feed"], missed)
+        else:
+            self.reschedule("same", newfeed.get("headers", {}),\
+                    newfeed["feed"])
+        self.set_fetch_state(fstate)
 
-                # Just a state modification by the client, update and continue.
-                else:
-                    curfeed = newer_curfeed
-                    continue
+# Close the pool in the middle of a parse, like a run that gives up on its
+# feeds does, and make sure the pool can still be refilled and used afterwards.
 
-            # Truncate the file
-            f.seek(0, 0)
-            f.truncate()
+def test_parse_pool():
+    entries = "".join([ "<item><title>%d</title><guid>%d</guid></item>" % (i, i)\
+            for i in xrange(5000) ])
+    big = "<rss version=\"2.0\"><channel><title>big</title>%s</channel></rss>"\
+            % entries
+    small = "<rss version=\"2.0\"><channel><title>small</title>"\
+            "<item><title>one</title></item></channel></rss>"
 
-            try:
-                # Dump the feed item. It's important to flush afterwards to
-                # avoid unlocking the file before all the IO is finished.
-                cPickle.dump(newfeed, f)
-                f.flush()
-            except:
-                self.log_func("cPickle dump exception on %s" % self.fpath)
-            finally:
-                # Unlock.
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+    def log(s):
+        pass
 
-            # If we managed to write to disk, break out of the while loop and
-            # the thread will exit.
+    def timeout(signum, frame):
+        raise Exception, "Parse pool hung"
 
-            break
+    signal.signal(signal.SIGALRM, timeout)
+    signal.alarm(60)
 
+    pool = ParsePool(1, log)
+    result = []
+    def parse():
+        try:
+            result.append(pool.parse(big, {}, "http://example.com/big"))
+        except:
+            result.append(None)
+    t = Thread(target=parse)
+    t.start()
+
+    while not pool.busy:
+        time.sleep(0.01)
+    time.sleep(0.1)
+
+    pool.close(True)
+    t.join()
+    if result != [None]:
+        raise Exception, "Parse survived closing the pool"
+
+    pool.refill()
+    if len(pool.procs) != 1:
+        raise Exception, "Pool not refilled: %s" % pool.procs
+    r = pool.parse(small, {}, "http://example.com/small")
+    if r["feed"]["title"] != "small" or len(r["entries"]) != 1:
+        raise Exception, "Bad parse after refill: %s" % r
+
+    # Limits changed on a running pool reach the parsers, and so do changes to
+    # its size.
+
+    pid = pool.procs[0][0]
+    pool.recycle = 1
+    pool.parse(small, {}, "http://example.com/small")
+    pool.refill()
+    if pool.procs[0][0] == pid:
+        raise Exception, "Parser not recycled"
+
+    pool.size = 3
+    pool.refill()
+    if len(pool.procs) != 3:
+        raise Exception, "Pool not grown: %s" % pool.procs
+    pool.size = 1
+    pool.refill()
+    if len(pool.procs) != 1:
+        raise Exception, "Pool not shrunk: %s" % pool.procs
+    pool.stop()
+
+    signal.alarm(0)
+    print "ParsePool tests passed"
+
+if __name__ == "__main__":
+    test_parse_pool()
@@ -13,13 +13,14 @@ def register(c):
     c.feeds = []
     c.default_rate = 5
     c.default_keep = 40
+    c.default_max_size = 10240
     c.never_discard = []
 
     def add(URL, **kwargs):
         if (not URL) or URL == "" or type(URL) not in [unicode, str]:
             raise Exception, "%s is not a valid URL" % URL
 
-        for key in ["keep","rate"]:
+        for key in ["keep","rate","max_size"]:
             if not key in kwargs:
                 kwargs[key] = getattr(c, "default_" + key)
             elif type(kwargs[key]) != int:
@@ -61,7 +62,8 @@ def register(c):
                     kwargs["keep"],
                     kwargs["filter"],
                     kwargs["username"],
-                    kwargs["password"]))
+                    kwargs["password"],
+                    kwargs["max_size"]))
         return True
 
     def change_feed(URL, **kwargs):
@@ -77,6 +79,9 @@ def register(c):
     def set_default_keep(keep):
         c.default_keep = keep
 
+    def set_default_max_size(max_size):
+        c.default_max_size = max_size
+
     def never_discard(tag):
         c.never_discard.append(tag)
 
@@ -85,6 +90,7 @@ def register(c):
         "change_feed" : change_feed,
         "default_rate" : set_default_rate,
         "default_keep" : set_default_keep,
+        "default_max_size" : set_default_max_size,
         "never_discard" : never_discard})
 
 def post_parse(c):
@@ -112,11 +118,14 @@ def test(c):
 
     c.locals["default_rate"](777)
     c.locals["default_keep"](777)
+    c.locals["default_max_size"](777)
     add("http://someotherurl")
     if c.feeds[1].rate != 777:
         raise Exception, "Set default rate not transferred"
     if c.feeds[1].keep != 777:
         raise Exception, "Set default keep not transferred"
+    if c.feeds[1].max_size != 777:
+        raise Exception, "Set default max_size not transferred"
 
     c.feeds = []
     try:
@@ -140,6 +149,13 @@ def test(c):
     else:
         raise Exception, "Invalid keep didn't raise exception"
 
+    try:
+        add("blah", max_size="bad")
+    except:
+        pass
+    else:
+        raise Exception, "Invalid max_size didn't raise exception"
+
     try:
         add("blah", username=0xdeadbeef)
     except:
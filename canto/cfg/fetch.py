@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# Settings that only canto-fetch cares about.
+
+def register(c):
+    c.fetch_workers = 10
+    c.fetch_host_workers = 2
+    c.fetch_parsers = 0
+    c.fetch_engine = "threads"
+    c.fetch_min_rate = 5
+    c.fetch_max_rate = 240
+    c.fetch_keepalive = 60
+    c.fetch_pool_size = 20
+    c.fetch_connect_timeout = 10
+    c.fetch_read_timeout = 30
+    c.fetch_max_time = 120
+    c.fetch_deadline = 0
+    c.fetch_remember_moved = True
+    c.fetch_dns_ttl = 300
+    c.fetch_dns_negative_ttl = 60
+    c.fetch_dns_prewarm = False
+    c.fetch_script_workers = 2
+    c.fetch_script_timeout = 60
+    c.fetch_parser_recycle = 0
+    c.fetch_parser_max_mem = 0
+    c.fetch_push_port = 0
+    c.fetch_push_address = ""
+    c.fetch_push_callback = ""
+    c.fetch_push_interval = 360
+    c.fetch_compress_level = 6
+
+    c.locals.update({
+        "fetch_workers" : c.fetch_workers,
+        "fetch_host_workers" : c.fetch_host_workers,
+        "fetch_parsers" : c.fetch_parsers,
+        "fetch_engine" : c.fetch_engine,
+        "fetch_min_rate" : c.fetch_min_rate,
+        "fetch_max_rate" : c.fetch_max_rate,
+        "fetch_keepalive" : c.fetch_keepalive,
+        "fetch_pool_size" : c.fetch_pool_size,
+        "fetch_connect_timeout" : c.fetch_connect_timeout,
+        "fetch_read_timeout" : c.fetch_read_timeout,
+        "fetch_max_time" : c.fetch_max_time,
+        "fetch_deadline" : c.fetch_deadline,
+        "fetch_remember_moved" : c.fetch_remember_moved,
+        "fetch_dns_ttl" : c.fetch_dns_ttl,
+        "fetch_dns_negative_ttl" : c.fetch_dns_negative_ttl,
+        "fetch_dns_prewarm" : c.fetch_dns_prewarm,
+        "fetch_script_workers" : c.fetch_script_workers,
+        "fetch_script_timeout" : c.fetch_script_timeout,
+        "fetch_parser_recycle" : c.fetch_parser_recycle,
+        "fetch_parser_max_mem" : c.fetch_parser_max_mem,
+        "fetch_push_port" : c.fetch_push_port,
+        "fetch_push_address" : c.fetch_push_address,
+        "fetch_push_callback" : c.fetch_push_callback,
+        "fetch_push_interval" : c.fetch_push_interval,
+        "fetch_compress_level" : c.fetch_compress_level})
+
+# Canto-fetch never calls validate() (that creates the tags, etc.), so the
+# fetch settings are checked as soon as they're parsed.
+
+def post_parse(c):
+    for attr in ["fetch_workers", "fetch_host_workers", "fetch_parsers",
+            "fetch_engine", "fetch_min_rate", "fetch_max_rate",
+            "fetch_keepalive", "fetch_pool_size", "fetch_connect_timeout",
+            "fetch_read_timeout", "fetch_max_time", "fetch_deadline",
+            "fetch_remember_moved", "fetch_dns_ttl", "fetch_dns_negative_ttl",
+            "fetch_dns_prewarm", "fetch_script_workers",
+            "fetch_script_timeout", "fetch_parser_recycle",
+            "fetch_parser_max_mem", "fetch_push_port", "fetch_push_address",
+            "fetch_push_callback", "fetch_push_interval",
+            "fetch_compress_level"]:
+        setattr(c, attr, c.locals[attr])
+    validate(c)
+
+def validate(c):
+    for attr in ["fetch_workers", "fetch_host_workers",
+            "fetch_connect_timeout", "fetch_read_timeout",
+            "fetch_script_workers", "fetch_push_interval"]:
+        if type(getattr(c, attr)) != int:
+            raise Exception, "%s must be an integer > 0." % attr
+        if getattr(c, attr) < 1:
+            raise Exception, "%s must be > 0, not %d." %\
+                    (attr, getattr(c, attr))
+
+    if type(c.fetch_parsers) != int:
+        raise Exception, "fetch_parsers must be an integer >= 0."
+    if c.fetch_parsers < 0:
+        raise Exception, "fetch_parsers must be >= 0, not %d." %\
+                c.fetch_parsers
+
+    if type(c.fetch_compress_level) != int or\
+            c.fetch_compress_level not in range(10):
+        raise Exception, "fetch_compress_level must be an integer 0-9."
+
+    for attr in ["fetch_min_rate", "fetch_max_rate", "fetch_keepalive",
+            "fetch_pool_size", "fetch_max_time", "fetch_deadline",
+            "fetch_dns_ttl", "fetch_dns_negative_ttl", "fetch_script_timeout",
+            "fetch_parser_recycle", "fetch_parser_max_mem", "fetch_push_port"]:
+        if type(getattr(c, attr)) != int:
+            raise Exception, "%s must be an integer >= 0." % attr
+        if getattr(c, attr) < 0:
+            raise Exception, "%s must be >= 0, not %d." %\
+                    (attr, getattr(c, attr))
+
+    for attr in ["fetch_remember_moved", "fetch_dns_prewarm"]:
+        if getattr(c, attr) not in [True, False]:
+            raise Exception, "%s must be True or False." % attr
+
+    for attr in ["fetch_push_address", "fetch_push_callback"]:
+        if type(getattr(c, attr)) not in [str, unicode]:
+            raise Exception, "%s must be a string." % attr
+
+    if c.fetch_engine not in ["threads", "select"]:
+        raise Exception, """fetch_engine must be "threads" or "select",""" +\
+            """ not "%s".""" % c.fetch_engine
+
+def test(c):
+    c.locals["fetch_workers"] = 0
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_workers didn't raise exception."
+
+    c.locals["fetch_workers"] = 4
+    c.locals["fetch_host_workers"] = "bad"
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_host_workers didn't raise exception."
+
+    c.locals["fetch_host_workers"] = 1
+    c.locals["fetch_parsers"] = -1
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_parsers didn't raise exception."
+
+    c.locals["fetch_parsers"] = 0
+    c.locals["fetch_engine"] = "poll"
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_engine didn't raise exception."
+
+    c.locals["fetch_engine"] = "select"
+    c.locals["fetch_max_rate"] = -1
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_max_rate didn't raise exception."
+
+    c.locals["fetch_max_rate"] = 0
+    c.locals["fetch_read_timeout"] = 0
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_read_timeout didn't raise exception."
+
+    c.locals["fetch_read_timeout"] = 30
+    c.locals["fetch_deadline"] = -1
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_deadline didn't raise exception."
+
+    c.locals["fetch_deadline"] = 0
+    c.locals["fetch_remember_moved"] = "yes"
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_remember_moved didn't raise exception."
+
+    c.locals["fetch_remember_moved"] = False
+    c.locals["fetch_dns_ttl"] = "300"
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_dns_ttl didn't raise exception."
+
+    c.locals["fetch_dns_ttl"] = 300
+    c.locals["fetch_push_callback"] = None
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_push_callback didn't raise exception."
+
+    c.locals["fetch_push_callback"] = ""
+    c.locals["fetch_compress_level"] = 10
+    try:
+        post_parse(c)
+    except:
+        pass
+    else:
+        raise Exception, "Invalid fetch_compress_level didn't raise exception."
+
+    c.locals["fetch_compress_level"] = 6
+    post_parse(c)
+    if c.fetch_workers != 4 or c.fetch_host_workers != 1:
+        raise Exception, "Fetch settings not transferred."
+    print "Fetch tests passed"
@@ -19,15 +19,17 @@
 # update() for updating from disk and todisk() to commit the current state when
 # Canto shuts down.
 
+# The feed file itself is only read. The stories' state is kept in a separate
+# file (see story_state.py), which is all todisk() writes.
+
 from const import STORY_QD, STORY_SAVED, STORY_UPDATED
+import story_state
+import storage
 import story
 
-import cPickle
-import fcntl
-
 class Feed(list):
     def __init__(self, cfg, dirpath, URL, tags, rate, keep, \
-            filter, username, password):
+            filter, username, password, max_size=0):
 
         # We pay attention to whether the base was set at creation time (i.e.
         # via the config) so that setting tags=["sometag"] on two feeds merges
@@ -45,6 +47,7 @@ class Feed(list):
         self.URL = URL
         self.rate = rate
         self.keep = keep
+        self.max_size = max_size
         self.username = username
         self.password = password
 
@@ -55,53 +58,56 @@ class Feed(list):
         self.filter = filter
 
         self.path = dirpath
+        self.state_path = story_state.state_path(dirpath)
+        self.generations = None
         self.cfg = cfg
 
     def __eq__(self, other):
         return self.URL == other.URL
 
-    def get_ufp(self):
-        lockflags = fcntl.LOCK_SH
-        if self.base_set:
-            lockflags |= fcntl.LOCK_NB
+    # get_ufp returns the feed from disk, with each entry's state filled in,
+    # and remembers the generations (see storage.py) of the feed and state
+    # files it was read from.
 
+    def get_ufp(self):
         try:
-            f = open(self.path, "r")
-            try:
-                fcntl.flock(f.fileno(), lockflags)
-                ufp = cPickle.load(f)
-            except ImportError:
-                try:
-
-                    # Fortunately, I don't think forcing the cpickle
-                    # to use feedparser_builtin is harmful, since they're
-                    # basically the same class, feedparser_builtin is just the
-                    # only way to properly look up the toplevel module now.
-
-                    f.seek(0)
-                    data = f.read()
-                    data = data.replace("feedparser\n","feedparser_builtin\n",1)
-                    ufp = cPickle.loads(data)
-                except:
-                    return 0
-            except:
+            generation, ufp = storage.load(self.path)
+            if not ufp:
                 return 0
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+            state_generation = story_state.attach(self.state_path,\
+                    ufp["entries"], self.tags + [u"*"])
         except:
             return 0
+
+        self.generations = (generation, state_generation)
         return ufp
 
     def update(self):
+        # If neither file has been written since we last read them, there's
+        # nothing new on disk, so we write out our own changes and filter the
+        # stories we have again, since their state may have changed. Our
+        # changes are written first, so that a story the filter drops isn't
+        # dropped before its state is saved. Files written before there were
+        # generations are all generation 0, and always reread.
+
+        if self.generations and self.generations[0] and self.generations ==\
+                (storage.generation(self.path),\
+                storage.generation(self.state_path)):
+            for item in self:
+                if self.add_tags(item["canto_state"]):
+                    item.updated = STORY_UPDATED
+            self.todisk()
+            self.refilter(list(self))
+            return 1
+
         ufp = self.get_ufp()
         if not ufp:
             return 0
 
         # If the base hasn't been set, attempt to set it from the data we just
-        # picked up. get_ufp() blocks if base isn't set so it's impossible that
-        # we'll just bail out unless there's a cPickle.load exception, but at
-        # that point we're totally fucked anyway.
+        # picked up. If get_ufp() fails, it's because there's nothing on disk
+        # yet, or a cPickle.load exception, and at that point we're totally
+        # fucked anyway.
 
         if not self.base_set:
             self.base_set = 1
@@ -113,7 +119,7 @@ class Feed(list):
             self.tags = [ replace(x) for x in self.tags]
 
         self.extend(ufp["entries"])
-        self.todisk(ufp)
+        self.todisk()
         return 1
 
     # Extend's job is to take items from disk, strip them down to the items that
@@ -151,8 +157,9 @@ class Feed(list):
                 nentry["title_detail"] = entry["title_detail"]
 
             for pc in self.cfg.precache:
-                if pc in entry:
-                    nentry[pc] = entry[pc]
+                key = storage.real_key(entry, pc)
+                if key != None:
+                    nentry[pc] = storage.value(entry, key)
                 else:
                     nentry[pc] = None
 
@@ -161,25 +168,37 @@ class Feed(list):
             elif "href" in entry:
                 nentry["link"] = entry["href"]
 
-            # If tags were added in the configuration, c-f won't
-            # notice (doesn't care about tags), so we check and
-            # append as needed.
-
             updated = STORY_SAVED
-            if self.tags[0] != nentry["canto_state"][0]:
-                nentry["canto_state"][0] = self.tags[0]
+            if self.add_tags(nentry["canto_state"]):
                 updated = STORY_UPDATED
 
-            for tag in self.tags[1:]:
-                if tag not in nentry["canto_state"]:
-                    nentry["canto_state"].append(tag)
-                    updated = STORY_UPDATED
-
             if nentry not in newlist:
                 newlist.append(story.Story(nentry, self.path, updated))
 
+        self.refilter(newlist)
+
+    # If tags were added in the configuration, c-f won't notice (doesn't care
+    # about tags), so we check and append as needed. Returns whether the state
+    # was changed.
+
+    def add_tags(self, state):
+        changed = False
+        if self.tags[0] != state[0]:
+            state[0] = self.tags[0]
+            changed = True
+
+        for tag in self.tags[1:]:
+            if tag not in state:
+                state.append(tag)
+                changed = True
+        return changed
+
+    # Replace the feed's stories with the ones in `stories` that pass the hard
+    # filter.
+
+    def refilter(self, stories):
         del self[:]
-        for item in newlist:
+        for item in stories:
             if not self.filter or self.filter(self, item):
                 list.append(self, item)
 
@@ -198,65 +217,57 @@ class Feed(list):
         del self[:]
         list.extend(self, iter)
 
-    # todisk is the complement to get_ufp, however, since the state may have
-    # changed on any of the items, it has to intelligently merge the changes
-    # before writing to disk.
-
-    def todisk(self, ufp=None):
-        if ufp == None:
-            ufp = self.get_ufp()
-        if not ufp:
-            return
+    # todisk writes the state of any stories that have changed to the state
+    # file. Since canto-fetch or another canto may have changed the file in the
+    # meantime, it has to intelligently merge the changes.
 
+    def todisk(self):
         changed = self.changed()
         if not changed :
             return
 
-        for entry in changed:
-            # We've stopped caring about this item
-            if entry not in ufp["entries"]:
-                continue
-
-            old = ufp["entries"][ufp["entries"].index(entry)]
-            if old["canto_state"] != entry["canto_state"]:
-                # States differ, and we've recorded an update, that means we
-                # probably have the newer information, so we handle the
-                # state_change_hook in a batch and overwrite the old data
-
-                if entry.updated:
-                    if self.cfg.state_change_hook:
-                        add = [t for t in entry["canto_state"] if\
-                               t not in old["canto_state"]]
-                        rem = [t for t in old["canto_state"] if\
-                               t not in entry["canto_state"]]
-                        self.cfg.state_change_hook(self, entry, add, rem)
-                    old["canto_state"] = entry["canto_state"]
-
+        def merge(states):
+            for entry in changed:
+                # We've stopped caring about this item
+                if entry["id"] not in states:
+                    continue
+
+                old = states[entry["id"]]
+                if old != entry["canto_state"]:
+                    # States differ, and we've recorded an update, that means
+                    # we probably have the newer information, so we handle the
+                    # state_change_hook in a batch and overwrite the old data
+
+                    if entry.updated:
+                        if self.cfg.state_change_hook:
+                            add = [t for t in entry["canto_state"] if\
+                                   t not in old]
+                            rem = [t for t in old if\
+                                   t not in entry["canto_state"]]
+                            self.cfg.state_change_hook(self, entry, add, rem)
+                        states[entry["id"]] = entry["canto_state"]
+
+                    # States differ, but we have no change, most likely the on
+                    # disk info is newer (i.e. changed by another running canto
+                    # instance). We count on the other canto instance handling
+                    # the state_change_hook.
+
+                    else:
+                        entry["canto_state"] = old
+            return states
+
+        generation = story_state.update(self.state_path, merge)
+        if generation == None:
+            return 0
 
-                # States differ, but we have no change, most likely the on disk
-                # info is newer (i.e. changed by another running canto
-                # instance). We count on the other canto instance handling the
-                # state_change_hook.
+        # If nobody else wrote the state file since we read it, what's on disk
+        # is still what we have.
 
-                else:
-                    entry["canto_state"] = old["canto_state"]
+        if self.generations and self.generations[1] == generation - 1:
+            self.generations = (self.generations[0], generation)
 
-        # Dump the feed to disk.
-        f = open(self.path, "r+")
-        try:
-            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-            f.seek(0, 0)
-            f.truncate()
-            cPickle.dump(ufp, f)
-            f.flush()
-            for x in changed:
-                x.updated = STORY_SAVED
-        except:
-            return 0
-        finally:
-            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-            f.close()
-        del ufp
+        for x in changed:
+            x.updated = STORY_SAVED
         return 1
 
     def changed(self):
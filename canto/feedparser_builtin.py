@@ -135,6 +135,7 @@ class CharacterEncodingOverride(ThingsNobodyCaresAboutButMe): pass
 class CharacterEncodingUnknown(ThingsNobodyCaresAboutButMe): pass
 class NonXMLContentType(ThingsNobodyCaresAboutButMe): pass
 class UndeclaredNamespace(Exception): pass
+class _StopParsing(Exception): pass
 
 sgmllib.tagfind = re.compile('[a-zA-Z][-_.:a-zA-Z0-9]*')
 sgmllib.special = re.compile('<!')
@@ -377,6 +378,9 @@ class _FeedParserMixin:
         self.incontributor = 0
         self.inpublisher = 0
         self.insource = 0
+        self.inskip = None
+        self.max_entries = 0
+        self.defer_html = 0
         self.sourcedata = FeedParserDict()
         self.contentparams = FeedParserDict()
         self._summaryKey = None
@@ -636,14 +640,21 @@ class _FeedParserMixin:
         except KeyError:
             pass
 
-        # resolve relative URIs within embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_relative_uris:
+        is_html = self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types
+        resolve = is_html and element in self.can_contain_relative_uris
+        sanitize = is_html and element in self.can_contain_dangerous_markup
+
+        # canto: leave the markup in entries alone for now, finish_entry()
+        # will do it later if the entry turns out to be worth the effort
+        deferred = self.defer_html and self.inentry and not self.insource and (resolve or sanitize)
+
+        if not deferred:
+            # resolve relative URIs within embedded markup
+            if resolve:
                 output = _resolveRelativeURIs(output, self.baseuri, self.encoding)
-        
-        # sanitize embedded markup
-        if self.mapContentType(self.contentparams.get('type', 'text/html')) in self.html_types:
-            if element in self.can_contain_dangerous_markup:
+
+            # sanitize embedded markup
+            if sanitize:
                 output = _sanitizeHTML(output, self.encoding)
 
         if self.encoding and type(output) != type(u''):
@@ -652,6 +663,9 @@ class _FeedParserMixin:
             except:
                 pass
 
+        if deferred and element != 'category':
+            self.entries[-1].setdefault('_deferred', []).append((output, self.baseuri, self.encoding, resolve, sanitize))
+
         # categories/tags/keywords/whatever are handled in _end_category
         if element == 'category':
             return output
@@ -1013,6 +1027,9 @@ class _FeedParserMixin:
     _end_copyright = _end_rights
 
     def _start_item(self, attrsD):
+        # canto: stop once we have as many entries as we were asked for
+        if self.max_entries and len(self.entries) >= self.max_entries:
+            raise _StopParsing
         self.entries.append(FeedParserDict())
         self.push('item', 0)
         self.inentry = 1
@@ -1143,6 +1160,39 @@ class _FeedParserMixin:
 
     def _start_cloud(self, attrsD):
         self._getContext()['cloud'] = FeedParserDict(attrsD)
+
+    # canto: collect RSS skipHours / skipDays into lists
+    def _start_skiphours(self, attrsD):
+        self.inskip = 'skiphours'
+        self._getContext()['skiphours'] = []
+    _start_skipHours = _start_skiphours
+
+    def _start_skipdays(self, attrsD):
+        self.inskip = 'skipdays'
+        self._getContext()['skipdays'] = []
+    _start_skipDays = _start_skipdays
+
+    def _end_skiphours(self):
+        self.inskip = None
+    _end_skipHours = _end_skiphours
+    _end_skipdays = _end_skiphours
+    _end_skipDays = _end_skiphours
+
+    def _start_hour(self, attrsD):
+        self.push('hour', 1)
+
+    def _start_day(self, attrsD):
+        self.push('day', 1)
+
+    def _end_hour(self):
+        value = self.pop('hour')
+        if self.inskip == 'skiphours' and value:
+            self._getContext()['skiphours'].append(value)
+
+    def _end_day(self):
+        value = self.pop('day')
+        if self.inskip == 'skipdays' and value:
+            self._getContext()['skipdays'].append(value)
         
     def _start_link(self, attrsD):
         attrsD.setdefault('rel', 'alternate')
@@ -2456,7 +2506,41 @@ def _stripDoctype(data):
     data = doctype_pattern.sub('', data)
     return version, data
     
-def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[]):
+# canto: with parse(..., defer_html=1), relative URIs in the markup of each
+# entry aren't resolved, and the markup isn't sanitized, until finish_entry() is
+# called on it. Every field of the entry that has the same unprocessed value is
+# replaced with the processed version.
+def finish_entry(entry):
+    done = {}
+    for output, baseuri, encoding, resolve, sanitize in entry.pop('_deferred', []):
+        value = output
+        if resolve:
+            value = _resolveRelativeURIs(value, baseuri, encoding)
+        if sanitize:
+            value = _sanitizeHTML(value, encoding)
+        if encoding and type(value) != type(u''):
+            try:
+                value = unicode(value, encoding)
+            except:
+                pass
+        done[id(output)] = (output, value)
+
+    def replace(obj):
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, list):
+            items = enumerate(obj)
+        else:
+            return
+        for k, v in items:
+            if id(v) in done and done[id(v)][0] is v:
+                obj[k] = done[id(v)][1]
+            else:
+                replace(v)
+    replace(entry)
+    return entry
+
+def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, referrer=None, handlers=[], max_entries=0, defer_html=0):
     '''Parse a feed from a URL, file, stream, or string'''
     result = FeedParserDict()
     result['feed'] = FeedParserDict()
@@ -2608,6 +2692,8 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
     if use_strict_parser:
         # initialize the SAX parser
         feedparser = _StrictFeedParser(baseuri, baselang, 'utf-8')
+        feedparser.max_entries = max_entries
+        feedparser.defer_html = defer_html
         saxparser = xml.sax.make_parser(PREFERRED_XML_PARSERS)
         saxparser.setFeature(xml.sax.handler.feature_namespaces, 1)
         saxparser.setContentHandler(feedparser)
@@ -2620,6 +2706,8 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             saxparser._ns_stack.append({'http://www.w3.org/XML/1998/namespace':'xml'})
         try:
             saxparser.parse(source)
+        except _StopParsing:
+            pass
         except Exception, e:
             if _debug:
                 import traceback
@@ -2631,7 +2719,12 @@ def parse(url_file_stream_or_string, etag=None, modified=None, agent=None, refer
             use_strict_parser = 0
     if not use_strict_parser:
         feedparser = _LooseFeedParser(baseuri, baselang, known_encoding and 'utf-8' or '')
-        feedparser.feed(data)
+        feedparser.max_entries = max_entries
+        feedparser.defer_html = defer_html
+        try:
+            feedparser.feed(data)
+        except _StopParsing:
+            pass
     result['feed'] = feedparser.feeddata
     result['entries'] = feedparser.entries
     result['version'] = result['version'] or feedparser.version
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# fetch_claim keeps canto-fetch runs in different processes (cron, the daemon,
+# canto -u, ...) from doing the same work at the same time.
+#
+# A claim is a file in the feed directory holding the claimer's PID, flock()ed
+# for as long as the claim is held. The lock goes away with the process, so a
+# claim left behind by a process that died is just an unlocked file, and is
+# taken over straight away. A process that's still alive, but hasn't renewed
+# its claim within the lease, is assumed to be stuck and its claim is taken over
+# by replacing the file.
+
+import fcntl
+import errno
+import time
+import os
+
+# Seconds a claim is good for without being renewed.
+LEASE = 600
+
+# Seconds between attempts while waiting on a claim.
+POLL = 0.5
+
+class Claim():
+    def __init__(self, path, lease=LEASE):
+        self.path = path
+        self.lease = lease
+        self.f = None
+
+    # Try to take the claim. Returns None if we have it, otherwise the PID of
+    # the process that does. If `wait` is set, keep trying until we have it or
+    # `until` passes.
+
+    def acquire(self, wait=False, until=None):
+        while True:
+            holder = self.try_acquire()
+            if not holder or not wait:
+                return holder
+            if until and time.time() > until:
+                return holder
+            time.sleep(POLL)
+
+    def try_acquire(self):
+        if self.f:
+            return None
+
+        while True:
+            f = open(self.path, "a+")
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError, e:
+                if e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    f.close()
+                    raise
+
+                f.seek(0, 0)
+                try:
+                    holder = int(f.read().strip() or 0)
+                except ValueError:
+                    holder = 0
+                st = os.fstat(f.fileno())
+                f.close()
+
+                if time.time() - st.st_mtime < self.lease:
+                    return holder or -1
+
+                # The holder is stuck. Replace the file, as long as it's still
+                # the one we looked at.
+
+                try:
+                    if os.stat(self.path).st_ino == st.st_ino:
+                        os.unlink(self.path)
+                except OSError:
+                    pass
+                continue
+
+            # The file might have been released (unlinked) or replaced while
+            # we were locking it, in which case our lock is worthless.
+
+            try:
+                if os.stat(self.path).st_ino != os.fstat(f.fileno()).st_ino:
+                    f.close()
+                    continue
+            except OSError:
+                f.close()
+                continue
+
+            self.f = f
+            self.renew()
+            return None
+
+    # Rewriting the file brings its mtime up to date, which is what the lease
+    # is checked against.
+
+    def renew(self):
+        if self.f:
+            self.f.seek(0, 0)
+            self.f.truncate()
+            self.f.write("%d\n" % os.getpid())
+            self.f.flush()
+
+    # Remove the file, unless someone's already taken it over, then unlock.
+
+    def release(self):
+        f, self.f = self.f, None
+        if not f:
+            return
+        try:
+            if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                os.unlink(self.path)
+        except OSError:
+            pass
+        f.close()
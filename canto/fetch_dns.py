@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# fetch_dns caches name lookups for canto-fetch, so that a few dozen hosts
+# serving hundreds of feeds are only looked up a few dozen times, rather than
+# once per feed.
+#
+# getaddrinfo() doesn't tell us the TTL of what it found, so answers are kept
+# for `ttl` seconds, and failures for `negative_ttl` seconds. A ttl of 0 turns
+# the cache off. Only one thread looks up any given name at a time, the others
+# wait for its answer.
+#
+# The lookup function defaults to socket.getaddrinfo, but any function that
+# takes the same arguments will do (i.e. a stub for testing).
+
+from threading import Thread, Condition
+import socket
+import time
+import sys
+
+class Resolver():
+    def __init__(self, ttl=300, negative_ttl=60, lookup=socket.getaddrinfo):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lookup = lookup
+        self.cond = Condition()
+
+        # Key -> (expiry time, addresses or the exception to raise)
+        self.cache = {}
+        self.pending = {}
+
+        self.cached = 0
+        self.resolved = 0
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        if not self.ttl:
+            return self.lookup(host, port, family, socktype, proto, flags)
+
+        key = (host, port, family, socktype, proto, flags)
+
+        self.cond.acquire()
+        try:
+            while True:
+                if key in self.cache and self.cache[key][0] > time.time():
+                    self.cached += 1
+                    return self.answer(self.cache[key][1])
+                if key not in self.pending:
+                    break
+                self.cond.wait()
+            self.pending[key] = True
+        finally:
+            self.cond.release()
+
+        error = None
+        try:
+            r = self.lookup(host, port, family, socktype, proto, flags)
+            expiry = time.time() + self.ttl
+        except socket.gaierror, e:
+            r = e
+            expiry = time.time() + self.negative_ttl
+        except:
+            # Not the name's fault, so don't remember it.
+            r = None
+            error = sys.exc_info()
+
+        self.cond.acquire()
+        del self.pending[key]
+        self.resolved += 1
+        if r != None:
+            self.cache[key] = (expiry, r)
+        self.cond.notify_all()
+        self.cond.release()
+
+        if error:
+            raise error[0], error[1], error[2]
+        return self.answer(r)
+
+    def answer(self, r):
+        if isinstance(r, Exception):
+            raise r
+        return r[:]
+
+    # socket.create_connection, with our lookups.
+
+    def create_connection(self, address,\
+            timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        host, port = address
+        err = None
+        for af, socktype, proto, canonname, sa in\
+                self.getaddrinfo(host, port, 0, socket.SOCK_STREAM):
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sa)
+                return sock
+            except socket.error, e:
+                err = e
+                if sock != None:
+                    sock.close()
+
+        if err != None:
+            raise err
+        raise socket.error("getaddrinfo returns an empty list")
+
+    # Look up all of the given (host, port) pairs with up to `workers` threads,
+    # so they're already cached when they're needed.
+
+    def prewarm(self, addresses, workers):
+        addresses = list(set(addresses))
+
+        def work():
+            while addresses:
+                try:
+                    host, port = addresses.pop()
+                except IndexError:
+                    return
+                try:
+                    self.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+                except:
+                    pass
+
+        threads = [ Thread(target = work) for i in\
+                xrange(min(workers, len(addresses))) ]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+
+    # Forget anything that's expired.
+
+    def expire(self):
+        self.cond.acquire()
+        now = time.time()
+        for key in self.cache.keys():
+            if self.cache[key][0] <= now:
+                del self.cache[key]
+        self.cond.release()
+
+    # Return the (cached, resolved) counts since the last call.
+
+    def stats(self):
+        self.cond.acquire()
+        r = (self.cached, self.resolved)
+        self.cached = 0
+        self.resolved = 0
+        self.cond.release()
+        return r
@@ -0,0 +1,354 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# HTTP odds and ends shared by canto-fetch's fetching engines.
+
+from threading import Lock, Timer
+import fetch_dns
+import urllib2
+import httplib
+import urlparse
+import urllib
+import socket
+import time
+import zlib
+
+# How much of a response to read (or decompress) at a time.
+READ_CHUNK = 65536
+
+# Decoder incrementally decompresses a response with the given Content-Encoding.
+# Each call returns at most READ_CHUNK bytes, and more() returns the rest a bit
+# at a time, so a tiny response can't decompress into a huge one all at once.
+
+class Decoder():
+    def __init__(self, encoding):
+        self.encoding = (encoding or "").strip().lower()
+        self.obj = None
+
+    def decompress(self, data):
+        if self.encoding in ["gzip", "x-gzip"]:
+            if not self.obj:
+                self.obj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        # Deflate is supposed to have a zlib header, but plenty of servers send
+        # raw deflate data instead.
+
+        elif self.encoding == "deflate":
+            if not self.obj:
+                if len(data) >= 2 and (ord(data[0]) & 0x0f) == 8 and\
+                        (ord(data[0]) * 256 + ord(data[1])) % 31 == 0:
+                    self.obj = zlib.decompressobj()
+                else:
+                    self.obj = zlib.decompressobj(-zlib.MAX_WBITS)
+        else:
+            return data
+
+        return self.obj.decompress(data, READ_CHUNK)
+
+    def more(self):
+        if self.obj and self.obj.unconsumed_tail:
+            return self.obj.decompress(self.obj.unconsumed_tail, READ_CHUNK)
+        return ""
+
+    def flush(self):
+        if self.obj:
+            return self.obj.flush()
+        return ""
+
+# Once the data has been decompressed, the headers shouldn't say it's still
+# compressed, or feedparser will try to decompress it again.
+
+def decoded_headers(lines):
+    return "".join([ l for l in lines if not\
+            l.lower().startswith("content-encoding:") ])
+
+# How long a socket operation may take, given its own timeout and the absolute
+# time by which the whole fetch has to be done (or None).
+
+def remaining(timeout, deadline):
+    if not deadline:
+        return timeout
+
+    left = deadline - time.time()
+    if left <= 0:
+        raise socket.timeout("timed out")
+    if type(timeout) not in [int, float]:
+        return left
+    return min(timeout, left)
+
+# ConnectionPool keeps HTTP/1.1 connections open after a feed has been fetched,
+# so the next feed on the same server (in this run, or the next one if
+# canto-fetch is running as a daemon) doesn't have to connect (and negotiate
+# SSL) all over again.
+#
+# Connections are keyed on (scheme, host, port). Connections that have been
+# idle for more than `timeout` seconds are closed, as are the longest idle ones
+# if there are more than `size` of them. A timeout of 0 turns pooling off.
+#
+# The server may well have closed an idle connection on its end, so a request
+# that fails on a pooled connection is retried once on a new one.
+#
+# New connections look up their host with the pool's Resolver, so the cache of
+# lookups lives as long as the pool does.
+#
+# Connecting is bounded by the request's timeout, and every read after that by
+# `read_timeout`. If there's a `deadline`, none of them can go past it, and a
+# response that's still being read at the deadline is cut off.
+
+class ConnectionPool():
+    def __init__(self, timeout=60, size=20):
+        self.timeout = timeout
+        self.size = size
+        self.resolver = fetch_dns.Resolver()
+        self.lock = Lock()
+        self.idle = []
+        self.reused = 0
+        self.opened = 0
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            self.expire()
+            for i in reversed(xrange(len(self.idle))):
+                if self.idle[i][0] == key:
+                    return self.idle.pop(i)[1]
+            return None
+        finally:
+            self.lock.release()
+
+    def put(self, key, conn):
+        if not self.timeout:
+            conn.close()
+            return
+
+        self.lock.acquire()
+        self.idle.append((key, conn, time.time()))
+        self.expire()
+        self.lock.release()
+
+    # Close anything that's been idle too long, or is over the limit. Must be
+    # called with the lock held.
+
+    def expire(self):
+        now = time.time()
+        while self.idle and (len(self.idle) > self.size or\
+                now - self.idle[0][2] > self.timeout):
+            self.idle.pop(0)[1].close()
+
+    def close(self):
+        self.lock.acquire()
+        for key, conn, t in self.idle:
+            conn.close()
+        self.idle = []
+        self.lock.release()
+
+    # Return the (reused, opened) counts since the last call.
+
+    def stats(self):
+        self.lock.acquire()
+        r = (self.reused, self.opened)
+        self.reused = 0
+        self.opened = 0
+        self.lock.release()
+        return r
+
+    # Do what urllib2's AbstractHTTPHandler.do_open does, but with a pooled
+    # connection, and without asking the server to close it.
+
+    def open(self, req, conn_class, read_timeout=None, deadline=None,\
+            **kwargs):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        h, port = urllib.splitport(host)
+        key = (req.get_type(), h.lower(), port or conn_class.default_port)
+
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict((k, v) for k, v in req.headers.items()\
+                if k not in headers))
+        headers = dict((name.title(), val) for name, val in headers.items())
+
+        conn = self.get(key)
+        while 1:
+            reused = conn != None
+            try:
+                if not reused:
+                    conn = conn_class(host,\
+                            timeout=remaining(req.timeout, deadline), **kwargs)
+                    conn._create_connection = self.resolver.create_connection
+                elif (read_timeout or deadline) and conn.sock:
+                    conn.sock.settimeout(remaining(read_timeout, deadline))
+                conn.request(req.get_method(), req.get_selector(), req.data,\
+                        headers)
+                if read_timeout or deadline:
+                    conn.sock.settimeout(\
+                            remaining(read_timeout or req.timeout, deadline))
+                r = conn.getresponse(buffering=True)
+            except (socket.error, httplib.HTTPException), err:
+                if conn:
+                    conn.close()
+                conn = None
+                if reused:
+                    continue
+                raise urllib2.URLError(err)
+            break
+
+        self.lock.acquire()
+        if reused:
+            self.reused += 1
+        else:
+            self.opened += 1
+        self.lock.release()
+
+        fp = PooledResponse(self, key, conn, r, deadline)
+        resp = urllib.addinfourl(socket._fileobject(fp, close=True), r.msg,\
+                req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+
+        # Nothing to read (i.e. a 304), so the connection is free already.
+        if r.length == 0:
+            fp.recv(0)
+        return resp
+
+# PooledResponse gives the connection back to the pool once its response has
+# been read to the end. If it's closed before then, the connection is closed
+# too, since there's no telling what's left on it.
+#
+# A single read can wait on the socket any number of times, so a server that
+# trickles the response out a byte at a time could hold it up indefinitely. If
+# there's a deadline, a timer shuts the socket down when it passes.
+
+class PooledResponse():
+    def __init__(self, pool, key, conn, r, deadline=None):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.r = r
+        self.expired = False
+
+        self.timer = None
+        if deadline:
+            self.timer = Timer(max(deadline - time.time(), 0), self.expire)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def expire(self):
+        self.expired = True
+        try:
+            self.conn.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+
+    def recv(self, n):
+        if self.expired:
+            raise socket.timeout("timed out")
+        data = self.r.read(n)
+        if self.expired:
+            raise socket.timeout("timed out")
+        if self.r.isclosed():
+            self.release()
+        return data
+
+    def release(self):
+        if self.timer:
+            self.timer.cancel()
+        if self.conn:
+            if self.r.will_close:
+                self.conn.close()
+            else:
+                self.pool.put(self.key, self.conn)
+            self.conn = None
+
+    def close(self):
+        if self.timer:
+            self.timer.cancel()
+        if self.conn:
+            if self.r.isclosed():
+                self.release()
+            else:
+                self.r.close()
+                self.conn.close()
+                self.conn = None
+
+class PoolHTTPHandler(urllib2.HTTPHandler):
+    def __init__(self, pool, read_timeout=None, deadline=None):
+        urllib2.HTTPHandler.__init__(self)
+        self.pool = pool
+        self.read_timeout = read_timeout
+        self.deadline = deadline
+
+    def http_open(self, req):
+        return self.pool.open(req, httplib.HTTPConnection,\
+                self.read_timeout, self.deadline)
+
+if hasattr(httplib, "HTTPSConnection"):
+    class PoolHTTPSHandler(urllib2.HTTPSHandler):
+        def __init__(self, pool, read_timeout=None, deadline=None):
+            urllib2.HTTPSHandler.__init__(self)
+            self.pool = pool
+            self.read_timeout = read_timeout
+            self.deadline = deadline
+
+        # HTTPS through a proxy needs a tunnel, which is left to urllib2.
+
+        def https_open(self, req):
+            if getattr(req, "_tunnel_host", None):
+                return urllib2.HTTPSHandler.https_open(self, req)
+
+            kwargs = {}
+            if getattr(self, "_context", None):
+                kwargs["context"] = self._context
+            return self.pool.open(req, httplib.HTTPSConnection,\
+                    self.read_timeout, self.deadline, **kwargs)
+
+# Redirects that mean the feed has moved for good.
+
+PERMANENT = [301, 308]
+
+# MovedHandler follows redirects like urllib2's own handler (and 308s as well),
+# remembering where the feed has permanently moved to: the last URL in the chain
+# of redirects that was only reached by permanent ones.
+
+class MovedHandler(urllib2.HTTPRedirectHandler):
+    def __init__(self):
+        self.moved = None
+        self.temporary = False
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        if code in PERMANENT and not self.temporary:
+            self.moved = newurl
+        else:
+            self.temporary = True
+
+        # urllib2 doesn't know 308, which is just a permanent 307.
+        if code == 308:
+            code = 307
+        return urllib2.HTTPRedirectHandler.redirect_request(self, req, fp,\
+                code, msg, headers, newurl)
+
+    http_error_308 = urllib2.HTTPRedirectHandler.http_error_301
+
+# Whether two URLs have the same scheme and host, i.e. whether it's safe to send
+# one the credentials meant for the other.
+
+def same_host(a, b):
+    a = urlparse.urlsplit(a)
+    b = urlparse.urlsplit(b)
+    return a.scheme.lower() == b.scheme.lower() and\
+            a.netloc.lower() == b.netloc.lower()
+
+# The handlers that make a urllib2 opener use the pool.
+
+def pool_handlers(pool, read_timeout=None, deadline=None):
+    handlers = [PoolHTTPHandler(pool, read_timeout, deadline)]
+    if hasattr(httplib, "HTTPSConnection"):
+        handlers.append(PoolHTTPSHandler(pool, read_timeout, deadline))
+    return handlers
@@ -0,0 +1,323 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# fetch_push lets the canto-fetch daemon be told about new items by WebSub
+# (PubSubHubbub) hubs, instead of having to poll for them.
+#
+# A feed that's published through a hub names it with <link rel="hub">. The
+# hub will POST the feed's new content to anyone that's subscribed as soon as
+# it's published. The Receiver is a small HTTP server for those POSTs.
+#
+# FetchThreads offer() the Receiver the hub and topic (the feed's rel="self"
+# link) of every feed they check, and the daemon subscribe()s to any that
+# aren't subscribed yet, or whose subscriptions are about to run out. The hub
+# makes sure we really asked with a GET to the feed's callback, after which it
+# POSTs to it. Pushed content is queued until the daemon take()s it and runs it
+# through the usual FetchThread merge and write.
+#
+# Each feed's callback is the SHA1 of its URL, under the callback URL, so that
+# subscribing again (i.e. after a restart) replaces the old subscription rather
+# than adding another. The hub signs what it pushes with a secret we make up
+# when the Receiver starts, and anything that isn't signed with it is dropped.
+#
+# Subscriptions aren't cancelled when the daemon exits, they just run out.
+
+from threading import Thread, Condition
+import BaseHTTPServer
+import SocketServer
+import urlparse
+import urllib2
+import urllib
+import hashlib
+import socket
+import hmac
+import time
+import os
+import re
+
+# How long a subscription lasts if the hub doesn't say.
+LEASE = 86400
+
+# Subscriptions are renewed when there's less than this many seconds (or half
+# the subscription) left, and ones the hub hasn't confirmed are asked for again
+# after this long.
+RENEW = 3600
+
+# The hashes a hub may sign pushes with.
+SIGNATURES = ["sha1", "sha256", "sha384", "sha512"]
+
+# Find the hub and topic of a feed, from its links or its Link header (given
+# in a dict of lowercase header names). The topic defaults to the feed's URL.
+
+def hub_links(URL, feed, headers={}):
+    links = []
+    for link in feed.get("links", []):
+        if link.get("href"):
+            links.append((link.get("rel", ""), link["href"]))
+
+    for m in re.finditer(r"<([^>]*)>([^,<]*)", headers.get("link", "")):
+        rel = re.search(r"""rel\s*=\s*"?([^";]*)""", m.group(2))
+        if rel:
+            for r in rel.group(1).split():
+                links.append((r.lower(), m.group(1)))
+
+    hub = [ href for rel, href in links if rel == "hub" ]
+    topic = [ href for rel, href in links if rel == "self" ]
+
+    if not hub:
+        return (None, None)
+    return (hub[0], topic and topic[0] or URL)
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def token(self):
+        return urlparse.urlsplit(self.path).path.strip("/")
+
+    def reply(self, code, body=""):
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # The hub checking that we asked to (un)subscribe.
+
+    def do_GET(self):
+        query = urlparse.parse_qs(urlparse.urlsplit(self.path).query)
+        get = lambda k: query.get(k, [""])[0]
+        code, body = self.server.receiver.verify(self.token(),\
+                get("hub.mode"), get("hub.topic"), get("hub.challenge"),\
+                get("hub.lease_seconds"), get("hub.reason"))
+        self.reply(code, body)
+
+    # New content.
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.getheader("Content-Length"))
+        except:
+            self.reply(411)
+            return
+
+        code = self.server.receiver.accepts(self.token(), length)
+        if code != 200:
+            self.reply(code)
+            return
+
+        self.server.receiver.push(self.token(), self.rfile.read(length),\
+                self.headers.headers,\
+                self.headers.getheader("X-Hub-Signature"))
+
+        # Even if the signature's wrong, the hub is meant to think it worked.
+        self.reply(200)
+
+    def log_message(self, format, *args):
+        pass
+
+class Receiver():
+    def __init__(self, address, port, callback, log_func):
+        if not callback:
+            callback = "http://%s:%d/" % (address or socket.getfqdn(), port)
+        if not callback.endswith("/"):
+            callback += "/"
+        self.callback = callback
+        self.log_func = log_func
+        self.secret = hashlib.sha1(os.urandom(20)).hexdigest()
+        self.cond = Condition()
+
+        # Token -> subscription dict (URL, hub, topic, max_size, when we last
+        # asked for it, how long the hub gave us and when that runs out)
+        self.subs = {}
+
+        # URL -> (hub, topic, max_size) for every feed that has a hub.
+        self.wanted = {}
+
+        # URL -> (data, headers, topic) pushed, but not taken yet. If a second
+        # push for a feed arrives first, the content is None, and the feed
+        # should just be fetched instead.
+        self.received = {}
+
+        self.server = Server((address, port), Handler)
+        self.server.receiver = self
+
+        t = Thread(target = self.server.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def token(self, URL):
+        return hashlib.sha1(URL.encode("UTF-8")).hexdigest()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # Called by FetchThreads with every feed they check (that hasn't failed).
+
+    def offer(self, URL, hub, topic, max_size=0):
+        self.cond.acquire()
+        if hub:
+            self.wanted[URL] = (hub, topic, max_size)
+        elif URL in self.wanted:
+            del self.wanted[URL]
+        self.cond.release()
+
+    # Forget about any feeds that aren't in the config anymore.
+
+    def sync(self, feeds):
+        URLs = [ fd.URL for fd in feeds ]
+        self.cond.acquire()
+        for URL in self.wanted.keys():
+            if URL not in URLs:
+                del self.wanted[URL]
+        for token in self.subs.keys():
+            if self.subs[token]["URL"] not in URLs:
+                del self.subs[token]
+        self.cond.release()
+
+    # Whether the hub has confirmed a subscription for the feed that hasn't
+    # run out yet.
+
+    def subscribed(self, URL):
+        self.cond.acquire()
+        sub = self.subs.get(self.token(URL))
+        r = sub != None and sub["expires"] > time.time()
+        self.cond.release()
+        return r
+
+    # Ask the hubs for any subscriptions we want but don't have, or that are
+    # running out.
+
+    def subscribe(self, timeout=None):
+        now = time.time()
+        asking = []
+
+        self.cond.acquire()
+        for URL, (hub, topic, max_size) in self.wanted.items():
+            token = self.token(URL)
+            sub = self.subs.get(token)
+            if sub and sub["hub"] == hub and sub["topic"] == topic:
+                if sub["expires"] - now > min(RENEW, sub["lease"] / 2):
+                    continue
+                if now - sub["asked"] < RENEW:
+                    continue
+                sub["asked"] = now
+            else:
+                sub = { "URL" : URL, "hub" : hub, "topic" : topic,
+                        "asked" : now, "lease" : 0, "expires" : 0 }
+                self.subs[token] = sub
+            sub["max_size"] = max_size
+            asking.append((hub, topic, token))
+        self.cond.release()
+
+        for hub, topic, token in asking:
+            data = urllib.urlencode({"hub.mode" : "subscribe",
+                "hub.topic" : topic.encode("UTF-8"),
+                "hub.callback" : self.callback + token,
+                "hub.secret" : self.secret})
+            try:
+                urllib2.urlopen(urllib2.Request(hub, data), timeout=timeout)\
+                        .close()
+                self.log_func("Subscribed to %s at %s" % (topic, hub))
+            except Exception, e:
+                self.log_func("Couldn't subscribe to %s at %s : %s" %\
+                        (topic, hub, e))
+
+    # Answer a hub's GET, returning (HTTP code, body).
+
+    def verify(self, token, mode, topic, challenge, lease, reason):
+        self.cond.acquire()
+        try:
+            sub = self.subs.get(token)
+            if not sub or sub["topic"] != unicode(topic, "UTF-8", "ignore"):
+                return (404, "")
+
+            if mode == "denied":
+                self.log_func("%s refused to push %s : %s" %\
+                        (sub["hub"], topic, reason))
+                del self.subs[token]
+                return (200, "")
+
+            if mode != "subscribe" or not challenge:
+                return (404, "")
+
+            try:
+                lease = int(lease)
+            except ValueError:
+                lease = LEASE
+            sub["lease"] = lease
+            sub["expires"] = time.time() + lease
+            return (200, challenge)
+        finally:
+            self.cond.release()
+
+    # Whether we'll take `length` bytes for this callback, as an HTTP code.
+
+    def accepts(self, token, length):
+        self.cond.acquire()
+        try:
+            sub = self.subs.get(token)
+            if not sub or not sub["expires"]:
+                return 404
+            if sub["max_size"] and length > sub["max_size"] * 1024:
+                return 413
+            return 200
+        finally:
+            self.cond.release()
+
+    def push(self, token, data, headers, signature):
+        self.cond.acquire()
+        try:
+            sub = self.subs.get(token)
+            if not sub:
+                return
+
+            if not signature or "=" not in signature:
+                self.log_func("Dropped unsigned push for %s" % sub["URL"])
+                return
+
+            # The comparison takes as long however much of the signature is
+            # right, so it can't be guessed a character at a time.
+
+            algorithm, signature = signature.split("=", 1)
+            if algorithm.lower() not in SIGNATURES or not\
+                    hmac.compare_digest(hmac.new(self.secret, data,\
+                    getattr(hashlib, algorithm.lower())).hexdigest(),\
+                    signature.lower()):
+                self.log_func("Dropped badly signed push for %s" % sub["URL"])
+                return
+
+            self.log_func("Received push for %s" % sub["URL"])
+            headers = "".join([ l for l in headers if not\
+                    l.lower().startswith("content-encoding:") ])
+            if sub["URL"] in self.received:
+                self.received[sub["URL"]] = None
+            else:
+                self.received[sub["URL"]] = (data, headers, sub["topic"])
+            self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+    # Wait until something's pushed, or `timeout` seconds pass.
+
+    def wait(self, timeout):
+        self.cond.acquire()
+        if not self.received and timeout > 0:
+            self.cond.wait(timeout)
+        self.cond.release()
+
+    # Return everything that's been pushed since last time.
+
+    def take(self):
+        self.cond.acquire()
+        r, self.received = self.received, {}
+        self.cond.release()
+        return r
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# fetch_rate decides when canto-fetch should next check a feed.
+#
+# Each feed's fetch state keeps a short history of how its checks went: "new"
+# if there were new items, "same" if nothing changed (a 304, or the same items
+# as before) and "error" if the check failed. From that, the interval between
+# checks adapts between fetch_min_rate and fetch_max_rate, starting at the
+# feed's own rate. It's halved every time something new turns up, and doubled
+# every time nothing did. If none of the old items were left in the feed, we
+# may have missed some, so the interval drops straight to the minimum.
+#
+# Failing feeds are retried with exponential backoff, starting at a minute.
+#
+# On top of that, whatever the feed or server asked for is honoured: <ttl>,
+# <skipHours> and <skipDays> from RSS, and the Cache-Control, Expires and
+# Retry-After headers. None of these can push a check past the maximum.
+
+import email.utils
+import time
+
+HISTORY = 20
+ERROR_RETRY = 60
+
+DAYS = ["monday", "tuesday", "wednesday", "thursday", "friday", "saturday",
+        "sunday"]
+
+# Add a result to the history.
+
+def record(fstate, result, now):
+    history = fstate.get("history", []) + [(now, result)]
+    fstate["history"] = history[-HISTORY:]
+
+# How many of the latest results in a row were `result`.
+
+def streak(fstate, result):
+    n = 0
+    for t, r in reversed(fstate.get("history", [])):
+        if r != result:
+            break
+        n += 1
+    return n
+
+# Parse an HTTP date into a timestamp, or None.
+
+def http_date(s):
+    try:
+        return email.utils.mktime_tz(email.utils.parsedate_tz(s))
+    except:
+        return None
+
+# The number of seconds the server asked us to wait, from a dict of lowercase
+# header names.
+
+def header_hint(headers, now):
+    hint = 0
+
+    if "retry-after" in headers:
+        value = headers["retry-after"].strip()
+        if value.isdigit():
+            hint = max(hint, int(value))
+        else:
+            t = http_date(value)
+            if t:
+                hint = max(hint, t - now)
+
+    cc = [ x.strip().lower() for x in headers.get("cache-control","").split(",")]
+    maxage = [ x for x in cc if x.startswith("max-age=") ]
+    if maxage:
+        try:
+            hint = max(hint, int(maxage[0][8:]))
+        except ValueError:
+            pass
+
+    # Expires is relative to the server's clock, if it gave us one.
+    elif "expires" in headers and "no-cache" not in cc:
+        expires = http_date(headers["expires"])
+        date = http_date(headers.get("date", "")) or now
+        if expires:
+            hint = max(hint, expires - date)
+
+    return hint
+
+# The number of seconds the feed asked us to wait, from <ttl>.
+
+def feed_hint(feed):
+    try:
+        return int(feed.get("ttl", 0)) * 60
+    except (ValueError, TypeError):
+        return 0
+
+# Move t past any of the feed's skipHours (GMT) and skipDays.
+
+def skip(t, feed):
+    hours = feed.get("skiphours", [])
+    days = feed.get("skipdays", [])
+    if type(hours) != list or type(days) != list:
+        return t
+
+    try:
+        hours = [ int(h) % 24 for h in hours ]
+    except ValueError:
+        hours = []
+    days = [ d.strip().lower() for d in days ]
+
+    # A feed that asks to never be checked is just broken.
+    if len(set(hours)) == 24 or len([d for d in DAYS if d in days]) == 7:
+        return t
+
+    for i in xrange(24 * 7):
+        tm = time.gmtime(t)
+        if tm.tm_hour not in hours and DAYS[tm.tm_wday] not in days:
+            break
+        t = t - (t % 3600) + 3600
+    return t
+
+# Work out the next time to check a feed, after `result` was recorded. rate,
+# min_rate and max_rate are in seconds. If max_rate is 0, the interval isn't
+# adapted, and the feed's rate is used as is.
+
+def next_check(fstate, now, rate, min_rate, max_rate, headers={}, feed={},\
+        missed=False):
+
+    if max_rate:
+        lo = min(rate, min_rate)
+        hi = max(rate, max_rate)
+    else:
+        lo = hi = rate
+
+    interval = fstate.get("interval", rate)
+    result = fstate["history"][-1][1]
+
+    if result == "new":
+        if missed:
+            interval = lo
+        else:
+            interval /= 2
+    elif result == "same":
+        interval *= 2
+
+    interval = min(max(interval, lo), hi)
+    fstate["interval"] = interval
+
+    if result == "error":
+        delay = min(ERROR_RETRY * 2 ** (streak(fstate, "error") - 1), hi)
+    else:
+        delay = interval
+
+    hint = max(header_hint(headers, now), feed_hint(feed))
+    delay = max(delay, min(hint, hi))
+
+    return skip(now + delay, feed)
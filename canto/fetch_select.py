@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The select engine is an alternative way for canto-fetch to do its network I/O.
+# Instead of each FetchPool worker making a blocking urllib2 request, a single
+# loop drives all of the HTTP requests with non-blocking sockets and poll(). As
+# each body completes, the FetchThread is handed to the FetchPool, which does the
+# parsing, merging and writing as usual.
+#
+# This is a deliberately small HTTP/1.0 client. Anything it doesn't handle
+# (script: feeds, feeds with passwords, proxies) is simply queued on the
+# FetchPool and fetched the usual way.
+
+from StringIO import StringIO
+import fetch_http
+import urlparse
+import urllib2
+import urllib
+import httplib
+import socket
+import select
+import errno
+import time
+import sys
+import os
+
+try:
+    import ssl
+except:
+    ssl = None
+
+MAX_REDIRECTS = 5
+
+CONNECTING = 0
+HANDSHAKE = 1
+SENDING = 2
+READING = 3
+
+# Errors that just mean "try again when poll() says so".
+RETRY_ERRNOS = [errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR]
+
+# A Connection gives up if it goes more than connect_timeout seconds without
+# connecting, or read_timeout seconds without any progress after that, or if it
+# goes on past `limit`. Hosts are looked up with `getaddrinfo`.
+
+class Connection():
+    def __init__(self, ft, url, headers, connect_timeout, read_timeout,\
+            max_size=0, limit=None, getaddrinfo=socket.getaddrinfo):
+        self.ft = ft
+        self.getaddrinfo = getaddrinfo
+        self.headers = headers
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_size = max_size
+        self.limit = limit
+        self.redirects = 0
+        self.moved = None
+        self.temporary = False
+        self.sock = None
+        self.begun = time.time()
+        self.start(url)
+
+    def start(self, url):
+        parts = urlparse.urlsplit(url)
+        self.url = url
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        if parts.port:
+            self.port = parts.port
+        elif self.scheme == "https":
+            self.port = 443
+        else:
+            self.port = 80
+
+        selector = parts.path or "/"
+        if parts.query:
+            selector += "?" + parts.query
+
+        lines = ["GET %s HTTP/1.0" % selector, "Host: %s" % parts.netloc]
+        lines += ["%s: %s" % h for h in self.headers]
+        lines += ["Connection: close", "", ""]
+        self.outbuf = "\r\n".join(lines)
+        if type(self.outbuf) == unicode:
+            self.outbuf = self.outbuf.encode("UTF-8")
+        self.inbuf = []
+        self.inlen = 0
+        self.head = None
+        self.truncated = False
+        self.ssl_want = None
+
+        family, socktype, proto, cname, addr = self.getaddrinfo(\
+                self.host, self.port, 0, socket.SOCK_STREAM)[0]
+        self.sock = socket.socket(family, socktype, proto)
+        self.sock.setblocking(0)
+
+        err = self.sock.connect_ex(addr)
+        if err not in [0, errno.EINPROGRESS] + RETRY_ERRNOS:
+            raise socket.error(err, os.strerror(err))
+
+        self.state = CONNECTING
+        self.touch()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def touch(self):
+        if self.state == CONNECTING:
+            self.deadline = time.time() + self.connect_timeout
+        else:
+            self.deadline = time.time() + self.read_timeout
+        if self.limit:
+            self.deadline = min(self.deadline, self.limit)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except:
+            pass
+
+    def events(self):
+        if self.ssl_want != None:
+            if self.ssl_want == ssl.SSL_ERROR_WANT_READ:
+                return select.POLLIN
+            return select.POLLOUT
+        if self.state in [CONNECTING, SENDING]:
+            return select.POLLOUT
+        return select.POLLIN
+
+    # ready() advances the connection as far as it can without blocking, and
+    # returns True once the whole response has been read.
+
+    def ready(self):
+        try:
+            return self.advance()
+        finally:
+            self.touch()
+
+    def advance(self):
+        if self.state == CONNECTING:
+            err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                raise socket.error(err, os.strerror(err))
+            if self.scheme == "https":
+                self.start_ssl()
+            else:
+                self.state = SENDING
+
+        if self.state == HANDSHAKE and self.ssl_call(self.sock.do_handshake):
+            self.state = SENDING
+
+        while self.state == SENDING:
+            sent = self.ssl_call(self.sock.send, self.outbuf)
+            if sent == None:
+                return False
+            self.outbuf = self.outbuf[sent:]
+            if not self.outbuf:
+                self.state = READING
+
+        while self.state == READING:
+            data = self.ssl_call(self.sock.recv, 65536)
+            if data == None:
+                return self.complete()
+            if not data:
+                return True
+            self.inbuf.append(data)
+            self.inlen += len(data)
+
+            # Stop reading once we have more than enough.
+            if self.max_size and self.parse_head() and\
+                    self.inlen - self.head[3] > self.max_size:
+                self.truncated = True
+                return True
+
+        return False
+
+    def start_ssl(self):
+        if not ssl:
+            raise Exception, "No SSL support."
+
+        if hasattr(ssl, "create_default_context"):
+            context = ssl.create_default_context()
+            self.sock = context.wrap_socket(self.sock,\
+                    server_hostname=self.host, do_handshake_on_connect=False)
+        else:
+            self.sock = ssl.wrap_socket(self.sock,\
+                    do_handshake_on_connect=False)
+        self.state = HANDSHAKE
+
+    # Call a socket function, returning None if it would have blocked. With
+    # SSL, what we're waiting on may not be what we'd expect (i.e. a send can
+    # need to read) so that's remembered for events().
+
+    def ssl_call(self, fn, *args):
+        self.ssl_want = None
+        try:
+            r = fn(*args)
+        except socket.error, e:
+            if ssl and isinstance(e, ssl.SSLError) and e.args[0] in\
+                    [ssl.SSL_ERROR_WANT_READ, ssl.SSL_ERROR_WANT_WRITE]:
+                self.ssl_want = e.args[0]
+                return None
+            if e.args[0] in RETRY_ERRNOS:
+                return None
+            raise
+        if r == None:
+            r = True
+        return r
+
+    # If the server told us how long the body is, we don't have to wait for it
+    # to close the connection.
+
+    def complete(self):
+        if not self.parse_head():
+            return False
+
+        status, msg, headers, bodystart = self.head
+        if status == 304 or status == 204 or status / 100 == 1:
+            return True
+
+        if "content-length" in headers and\
+                "transfer-encoding" not in headers:
+            try:
+                length = int(headers["content-length"])
+            except ValueError:
+                return False
+            return self.inlen - bodystart >= length
+        return False
+
+    # Parse the status line and headers, once they've all arrived.
+
+    def parse_head(self):
+        if self.head:
+            return self.head
+
+        data = "".join(self.inbuf)
+        self.inbuf = [data]
+
+        end = data.find("\r\n\r\n")
+        if end < 0:
+            return None
+
+        status_line, header_text = (data[:end] + "\r\n").split("\r\n", 1)
+        try:
+            version, status, msg = (status_line.split(None, 2) + [""])[:3]
+            status = int(status)
+        except:
+            raise httplib.BadStatusLine(status_line)
+
+        headers = httplib.HTTPMessage(StringIO(header_text + "\r\n"))
+        self.head = (status, msg.strip(), headers, end + 4)
+        return self.head
+
+    # Once the connection's done, result() returns the response as
+    # (status, msg, headers, header text, body).
+
+    def result(self):
+        if not self.parse_head():
+            raise httplib.IncompleteRead("".join(self.inbuf))
+
+        status, msg, headers, bodystart = self.head
+        body = "".join(self.inbuf)[bodystart:]
+
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            body = dechunk(body)
+        elif "content-length" in headers:
+            try:
+                body = body[:int(headers["content-length"])]
+            except ValueError:
+                pass
+
+        return (status, msg, headers,\
+                fetch_http.decoded_headers(headers.headers), body)
+
+# We ask for HTTP/1.0, so we shouldn't get a chunked response, but some servers
+# do it anyway.
+
+def dechunk(body):
+    out = []
+    while "\r\n" in body:
+        size, body = body.split("\r\n", 1)
+        size = int(size.split(";")[0], 16)
+        if not size:
+            break
+        out.append(body[:size])
+        body = body[size + 2:]
+    return "".join(out)
+
+# Each fetch gets at most max_time seconds (0 for no limit), and none are
+# started, or allowed to go on, after the run's deadline (if any). run() returns
+# the FetchThreads that weren't started in time.
+
+class SelectEngine():
+    def __init__(self, pool, connections, host_connections, connect_timeout,\
+            read_timeout, max_time, deadline, resolver, log_func):
+        self.pool = pool
+        self.resolver = resolver
+        self.connections = connections
+        self.host_connections = host_connections
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_time = max_time
+        self.deadline = deadline
+        self.log_func = log_func
+
+    # Whether this engine can fetch the feed itself, rather than passing it off
+    # to the FetchPool to be fetched with urllib2.
+
+    def usable(self, ft):
+        if ft.fd.username or ft.fd.password:
+            return False
+
+        parts = urlparse.urlsplit(ft.fd.URL)
+        if parts.scheme not in ["http", "https"]:
+            return False
+        if parts.scheme == "https" and not ssl:
+            return False
+        if parts.username or parts.password:
+            return False
+        if parts.scheme in urllib.getproxies():
+            return False
+        return True
+
+    def run(self, fts):
+        pending = []
+        for ft in fts:
+            if self.usable(ft):
+                pending.append(ft)
+            else:
+                self.pool.add(ft)
+
+        conns = {}
+        hosts = {}
+        abandoned = []
+        poll = select.poll()
+
+        def remove(c):
+            del conns[c.fileno()]
+            poll.unregister(c.fileno())
+            c.close()
+
+        def finish(c):
+            remove(c)
+            hosts[c.hostkey] -= 1
+            c.ft.elapsed += time.time() - c.begun
+
+        while pending or conns:
+
+            if pending and self.deadline and time.time() > self.deadline:
+                abandoned = pending
+                pending = []
+
+            # Start as many connections as the limits allow.
+
+            for ft in pending[:]:
+                if len(conns) >= self.connections:
+                    break
+
+                h = urlparse.urlsplit(ft.fd.URL).hostname
+                if hosts.get(h, 0) >= self.host_connections:
+                    continue
+                pending.remove(ft)
+
+                if not ft.prepare():
+                    continue
+
+                limit = self.deadline
+                if self.max_time:
+                    limit = min(limit or sys.maxint, time.time() + self.max_time)
+
+                request = ft.request()
+                try:
+                    c = Connection(ft, request.get_full_url(),\
+                            request.header_items(), self.connect_timeout,\
+                            self.read_timeout, ft.fd.max_size * 1024, limit,\
+                            self.resolver.getaddrinfo)
+                except:
+                    ft.fetch_error(sys.exc_info()[1])
+                    continue
+
+                c.hostkey = h
+                hosts[h] = hosts.get(h, 0) + 1
+                conns[c.fileno()] = c
+                poll.register(c.fileno(), c.events())
+
+            if not conns:
+                continue
+
+            for fd, event in poll.poll(1000):
+                if fd not in conns:
+                    continue
+                c = conns[fd]
+
+                try:
+                    if not c.ready():
+                        poll.modify(fd, c.events())
+                        continue
+                    status, msg, headers, header_text, body = c.result()
+                except:
+                    finish(c)
+                    c.ft.fetch_error(sys.exc_info()[1])
+                    continue
+
+                # Follow redirects on a new connection, remembering where
+                # the feed has permanently moved to, like MovedHandler.
+
+                if status in [301, 302, 303, 307, 308] and\
+                        "location" in headers and c.redirects < MAX_REDIRECTS:
+                    remove(c)
+                    c.redirects += 1
+                    url = urlparse.urljoin(c.url, headers["location"])
+                    if status in fetch_http.PERMANENT and not c.temporary:
+                        c.moved = url
+                    else:
+                        c.temporary = True
+                    try:
+                        c.start(url)
+                    except:
+                        hosts[c.hostkey] -= 1
+                        c.ft.fetch_error(sys.exc_info()[1])
+                        continue
+                    conns[c.fileno()] = c
+                    poll.register(c.fileno(), c.events())
+                    continue
+
+                finish(c)
+                c.ft.moved = c.moved
+
+                # Anything but a 200 is handled like urllib2 would have.
+
+                if status != 200:
+                    c.ft.fetch_error(urllib2.HTTPError(c.url, status, msg,\
+                            headers, None))
+                    continue
+
+                # Hand it off to be parsed, merged and written.
+
+                # Decompress the body, with the same limit on its size as
+                # a urllib2 fetch.
+
+                try:
+                    body = c.ft.read(StringIO(body),\
+                            headers.getheader("content-encoding"))
+                except:
+                    c.ft.fetch_error(sys.exc_info()[1])
+                    continue
+
+                if c.truncated and not c.ft.truncated:
+                    body = c.ft.truncate(body)
+                c.ft.fetched = (body, header_text, c.url)
+                self.pool.add(c.ft)
+
+            now = time.time()
+            for c in conns.values():
+                if now > c.deadline:
+                    finish(c)
+                    c.ft.fetch_error(socket.timeout("timed out"))
+
+        return abandoned
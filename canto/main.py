@@ -151,9 +151,23 @@ class Main():
             self.cfg.log("Conf was auto-generated, adding -u")
             flags |= UPDATE_FIRST
 
+        # The feeds in the first set of tags are the first ones shown, so
+        # they're fetched first. Without any tags set (or with None, the
+        # default set, first) every feed is shown under its own tag, in the
+        # order of the config, so the first feed goes first. Its tag may not
+        # be known until it's fetched, so it goes by URL.
+
+        first = None
+        tags = self.cfg.tags
+        if type(tags) == list and tags and type(tags[0]) == list:
+            first = tags[0]
+        elif (tags == None or (type(tags) == list and tags and\
+                tags[0] == None)) and self.cfg.feeds:
+            first = [ self.cfg.feeds[0].tags[0] or self.cfg.feeds[0].URL ]
+
         if flags & UPDATE_FIRST:
             self.cfg.log("Pausing to update...")
-            canto_fetch.run(self.cfg, True, True)
+            canto_fetch.run(self.cfg, True, True, first=first, wait=True)
 
         # Detect if there are any new feeds by whether their
         # set path exists. If not, run canto-fetch but don't
@@ -162,7 +176,8 @@ class Main():
         for i,f in enumerate(self.cfg.feeds) :
             if not os.path.exists(f.path):
                 self.cfg.log("Detected unfetched feed: %s." % f.URL)
-                canto_fetch.run(self.cfg, True, False)
+                canto_fetch.run(self.cfg, True, False, first=first,\
+                        wait=True)
 
                 #Still no go?
                 if not os.path.exists(f.path):
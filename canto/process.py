@@ -260,8 +260,7 @@ class ProcessHandler():
             if action == PROC_SYNC:
                 feed = [ f for f in feeds if f.URL == args[0] ][0]
                 feed.merge(args[1])
-                while feed.changed():
-                    feed.todisk()
+                feed.todisk()
                 send((PROC_SYNC,))
                 continue
 
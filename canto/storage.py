@@ -0,0 +1,368 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# storage reads and writes the files in the feed directory: the feeds, the
+# stories' state (story_state.py) and canto-fetch's fetch state.
+#
+# Files are never changed in place. The new version is written to a temporary
+# file beside the old one and renamed over it, so a reader always gets one
+# version or the other, whole, and never has to wait on a lock.
+#
+# Each file starts with its generation, which goes up by one every time it's
+# written. generation() only reads that far, so checking whether a file has
+# changed is cheap, and save() can refuse to overwrite a generation the writer
+# hasn't seen.
+#
+# Writers still have to take turns. A writer flock()s the current file, and then
+# makes sure it's still the current one, since it may have been renamed over
+# while we waited for the lock (just like fetch_claim).
+#
+# Feeds are written "indexed", so that a single entry can be read without the
+# rest. After the header comes a list of (entry id, offset) and then the feed
+# itself, without its entries, followed by each entry pickled separately. The
+# offsets are from the start of the feed. load() reads the whole lot back into
+# the usual feed dict, load_entry() reads the list, seeks and reads just the
+# one entry.
+#
+# Everything is pickled with the binary protocol, and only as plain dicts,
+# lists and tuples (see plain()), so loading never has to import feedparser or
+# build its classes. The header records the FORMAT the file was written in,
+# and the canto_version that wrote it. Files in an older format (text pickles
+# of FeedParserDicts) are still read, and converted as they're read. Canto-fetch
+# rewrites them the first time it loads them.
+#
+# Most of a feed file is the descriptions and content of its entries, which
+# canto only needs for the one story being read. Feeds can be written with
+# those fields (BULKY) zlib compressed, together, under COMPRESSED in each entry.
+# They're left that way when they're read, and only decompressed by value(),
+# so loading a feed for its titles and links never pays for them.
+
+from const import VERSION_TUPLE
+
+from StringIO import StringIO
+import cStringIO
+import tempfile
+import cPickle
+import fcntl
+import zlib
+import time
+import stat
+import os
+
+HEADER = "canto-storage"
+INDEXED = "indexed"
+PROTOCOL = cPickle.HIGHEST_PROTOCOL
+
+# FORMAT 0 is text pickles of whatever we were given, FORMAT 1 is binary pickles
+# of plain types.
+FORMAT = 1
+
+COMPRESSED = "canto_compressed"
+BULKY = ["summary", "summary_detail", "subtitle", "subtitle_detail", "content"]
+
+# Entries whose BULKY fields pickle to less than this aren't worth compressing.
+MIN_COMPRESS = 256
+
+# Feedparser's FeedParserDicts also answer to older names for some of their
+# keys ("description" is really "summary"). The dicts we store don't, so
+# real_key() looks them up instead.
+
+ALIASES = {"channel" : ["feed"],
+           "items" : ["entries"],
+           "guid" : ["id"],
+           "date" : ["updated"],
+           "date_parsed" : ["updated_parsed"],
+           "description" : ["subtitle", "summary"],
+           "url" : ["href"],
+           "modified" : ["updated"],
+           "modified_parsed" : ["updated_parsed"],
+           "issued" : ["published"],
+           "issued_parsed" : ["published_parsed"],
+           "copyright" : ["rights"],
+           "copyright_detail" : ["rights_detail"],
+           "tagline" : ["subtitle"],
+           "tagline_detail" : ["subtitle_detail"]}
+
+# Temporary files are named after the file they'll replace, so that
+# canto-fetch's cleanup can tell them apart from files it doesn't know.
+
+def temporary(name):
+    return name.startswith(".") and name.endswith(".tmp")
+
+# The key that d really holds `key` under, or None if it doesn't have it.
+# The field may be compressed, so get it with value().
+
+def real_key(d, key):
+    packed = d.get(COMPRESSED, ([], None))[0]
+    for k in [key] + ALIASES.get(key, []):
+        if k in d or k in packed:
+            return k
+    return None
+
+# d[key], where key is one that real_key() returned. The first compressed field
+# asked for decompresses all of them into d.
+
+def value(d, key):
+    if key not in d:
+        decompress(d)
+    return d[key]
+
+def decompress(d):
+    keys, data = d.pop(COMPRESSED)
+    for key, v in cPickle.loads(zlib.decompress(data)).iteritems():
+        d.setdefault(key, v)
+
+# A copy of entry with its BULKY fields compressed at the given zlib level, or
+# decompressed if the level is 0. An entry that's already compressed is kept as
+# it is.
+
+def compress(entry, level):
+    if COMPRESSED in entry:
+        if level and not [ k for k in BULKY if k in entry ]:
+            return entry
+        entry = entry.copy()
+        decompress(entry)
+
+    if not level:
+        return entry
+
+    # The fields are pickled together, so that the text feedparser puts in
+    # both "summary" and "summary_detail" is only stored once.
+
+    fields = dict([ (k, entry[k]) for k in BULKY if k in entry ])
+    data = cPickle.dumps(fields, PROTOCOL)
+    if len(data) < MIN_COMPRESS:
+        return entry
+
+    entry = entry.copy()
+    for key in fields:
+        del entry[key]
+    entry[COMPRESSED] = (fields.keys(), zlib.compress(data, level))
+    return entry
+
+# A copy of obj made only of dicts, lists, tuples and the simple types that were
+# in it. Feedparser's dicts lose their class (and their aliases), and its dates
+# become plain 9-tuples, which the time module takes just the same.
+
+def plain(obj):
+    if isinstance(obj, dict):
+        return dict([ (k, plain(v)) for k, v in obj.iteritems() ])
+    if isinstance(obj, list):
+        return [ plain(v) for v in obj ]
+    if isinstance(obj, tuple):
+        return tuple([ plain(v) for v in obj ])
+    if isinstance(obj, time.struct_time):
+        return tuple(obj)
+    return obj
+
+# Return (generation, contents) from an open file. Missing and empty files are
+# (0, None), and files written before there were generations are generation 0.
+
+def read(f, fix=True):
+    try:
+        obj = cPickle.load(f)
+        generation, format, indexed, level = describe(obj)
+        if not is_header(obj):
+            contents = obj
+        elif not indexed:
+            contents = cPickle.load(f)
+        else:
+            index = cPickle.load(f)
+            contents = cPickle.load(f)
+            contents["entries"] = [ cPickle.load(f) for i in index ]
+    except EOFError:
+        return (0, None)
+    except ImportError:
+        if not fix:
+            raise
+
+        # Feeds pickled when feedparser was its own module refer to it by
+        # that name. Fortunately, I don't think forcing the cpickle to use
+        # feedparser_builtin is harmful, since they're basically the same
+        # class, feedparser_builtin is just the only way to properly look up
+        # the toplevel module now. Files in the current FORMAT don't refer to
+        # any module at all.
+
+        f.seek(0)
+        data = f.read().replace("feedparser\n", "feedparser_builtin\n")
+        return read(StringIO(data), False)
+
+    if format < FORMAT:
+        contents = plain(contents)
+    return (generation, contents)
+
+def is_header(obj):
+    return type(obj) == tuple and len(obj) in [2, 3] and obj[0] == HEADER
+
+# (generation, FORMAT, indexed, compression level) of a file, given the first
+# thing pickled in it.
+
+def describe(obj):
+    if not is_header(obj):
+        return (0, 0, False, 0)
+    if len(obj) == 2:
+        return (obj[1], 0, False, 0)
+    if obj[2] == INDEXED:
+        return (obj[1], 0, True, 0)
+    return (obj[1], obj[2]["format"], obj[2]["indexed"],\
+            obj[2].get("level", 0))
+
+def load(path):
+    if not os.path.isfile(path):
+        return (0, None)
+    f = open(path, "rb")
+    try:
+        return read(f)
+    finally:
+        f.close()
+
+def generation(path):
+    return header(path)[0]
+
+# describe() the file at path, without reading any more of it than the header.
+
+def header(path):
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return (0, 0, False, 0)
+    try:
+        return read_header(f)
+    finally:
+        f.close()
+
+def read_header(f):
+    try:
+        return describe(cPickle.load(f))
+    except:
+        return (0, 0, False, 0)
+
+# Return the first entry with the given id in the feed at path, or None.
+
+def load_entry(path, id):
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None
+    try:
+        generation, format, indexed, level = read_header(f)
+        if not indexed:
+            f.close()
+            feed = load(path)[1]
+            for entry in feed["entries"]:
+                if entry["id"] == id:
+                    return entry
+            return None
+
+        for entry_id, offset in cPickle.load(f):
+            if entry_id == id:
+                break
+        else:
+            return None
+
+        f.seek(offset, 1)
+        entry = cPickle.load(f)
+        if format < FORMAT:
+            entry = plain(entry)
+        return entry
+    finally:
+        f.close()
+
+# Take the writer's lock on path, creating it (empty) if need be. The lock is
+# held until the returned file is closed.
+
+def lock(path):
+    while True:
+        f = open(path, "a+b")
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            if os.stat(path).st_ino == os.fstat(f.fileno()).st_ino:
+                f.seek(0, 0)
+                return f
+        except OSError:
+            pass
+        f.close()
+
+# Write obj to path as the given generation. The caller holds the lock.
+
+def write(path, generation, obj, indexed=False, level=0):
+    head, tail = os.path.split(path)
+    fd, tmp = tempfile.mkstemp(".tmp", "." + tail + ".", head)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            os.fchmod(fd, stat.S_IMODE(os.stat(path).st_mode))
+            info = { "format" : FORMAT, "canto_version" : VERSION_TUPLE,
+                    "indexed" : indexed, "level" : indexed and level }
+            cPickle.dump((HEADER, generation, info), f, PROTOCOL)
+            if indexed:
+                write_indexed(f, plain(obj), level)
+            else:
+                cPickle.dump(plain(obj), f, PROTOCOL)
+
+            # Without this, a crash could leave the rename on disk, but not
+            # the data.
+            f.flush()
+            os.fsync(fd)
+        finally:
+            f.close()
+        os.rename(tmp, path)
+    except:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+
+def write_indexed(f, feed, level):
+    entries = [ compress(e, level) for e in feed["entries"] ]
+    del feed["entries"]
+
+    data = cStringIO.StringIO()
+    cPickle.dump(feed, data, PROTOCOL)
+    index = []
+    for entry in entries:
+        index.append((entry["id"], data.tell()))
+        cPickle.dump(entry, data, PROTOCOL)
+
+    cPickle.dump(index, f, PROTOCOL)
+    f.write(data.getvalue())
+
+# Write obj, returning its generation. If `expect` is given and the file isn't
+# at that generation anymore (i.e. someone else has written it since we read
+# it), nothing is written and None is returned. The entries of indexed feeds
+# are compressed at zlib `level`, if it isn't 0.
+
+def save(path, obj, expect=None, indexed=False, level=0):
+    f = lock(path)
+    try:
+        current = read_header(f)[0]
+        if expect != None and current != expect:
+            return None
+
+        write(path, current + 1, obj, indexed, level)
+        return current + 1
+    finally:
+        f.close()
+
+# Replace the contents of path with func(contents), returning the new
+# generation. Contents are None if the file doesn't exist yet.
+
+def update(path, func):
+    f = lock(path)
+    try:
+        try:
+            current, obj = read(f)
+        except:
+            current, obj = (0, None)
+
+        write(path, current + 1, func(obj))
+        return current + 1
+    finally:
+        f.close()
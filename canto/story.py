@@ -19,8 +19,7 @@
 # the feed is the get_ufp function that gets the feedparser dict from disk.
 
 from const import STORY_SAVED, STORY_UPDATED
-import cPickle
-import fcntl
+import storage
 
 class Story():
     def __init__(self, d, ufp_path, updated):
@@ -49,32 +48,17 @@ class Story():
     def __str__(self):
         return self.d["title"] + " " + str(id(self))
 
-    # Where get_ufp reads the ufp from disk, this narrows that down to a
-    # particular feed entry.
+    # Where get_ufp reads the ufp from disk, this reads just this story's
+    # entry (see storage.py).
 
     def get_ufp_entry(self):
         if not self.ufp_path:
             return {}
 
         try:
-            f = open(self.ufp_path, "r")
-            try:
-                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
-                ufp = cPickle.load(f)
-            except:
-                return {}
-            finally:
-                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
-                f.close()
+            self.ondisk = storage.load_entry(self.ufp_path, self["id"])
         except:
-            return {}
-
-        for ondisk in ufp["entries"]:
-            if ondisk["id"] == self["id"]:
-                break
-        else:
             self.ondisk = None
-        self.ondisk = ondisk
 
     def __getitem__(self, key):
         if key in self.d:
@@ -86,8 +70,9 @@ class Story():
                 self.get_ufp_entry()
             if not self.ondisk:
                 return ""
-            if key in self.ondisk:
-                return self.ondisk[key]
+            key = storage.real_key(self.ondisk, key)
+            if key != None:
+                return storage.value(self.ondisk, key)
             return ""
 
     def __setitem__(self, key, item):
@@ -101,7 +86,7 @@ class Story():
                 self.get_ufp_entry()
             if not self.ondisk:
                 return False
-            return key in self.ondisk
+            return storage.real_key(self.ondisk, key) != None
 
     def was(self, tag):
         return tag in self.d["canto_state"]
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+
+#Canto - ncurses RSS reader
+#   Copyright (C) 2008 Jack Miller <jack@codezen.org>
+#
+#   This program is free software; you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License version 2 as
+#   published by the Free Software Foundation.
+
+# The state of each story (its tags, "read", "marked", etc.) is kept in a small
+# file beside the feed, a pickled dict of story id -> canto_state. The feed file
+# itself is only ever written by canto-fetch, so marking a story read only has
+# to rewrite the state file, rather than every description in the feed.
+#
+# Both canto and canto-fetch write the state file, so it's only ever changed
+# with update(), which rereads it as the writer (see storage.py) and writes it
+# back. Canto-fetch adds new stories and drops the ones that have left the feed,
+# but never changes the state of a story that's already there. Canto only ever
+# changes stories that are already there.
+#
+# Older versions of canto-fetch kept the state in each entry of the feed. If
+# there's no state file yet, it's made from those.
+
+from const import VERSION_TUPLE
+import storage
+
+import copy
+import os
+
+def state_path(fpath):
+    head, tail = os.path.split(fpath)
+    return os.path.join(head, "." + tail + ".state")
+
+# Return (generation, id -> canto_state dict), or (0, None) if there's no state
+# file or it couldn't be read.
+
+def load(path):
+    try:
+        generation, state = storage.load(path)
+        return (generation, state["stories"])
+    except:
+        return (0, None)
+
+# Call func with the current id -> canto_state dict (empty if there's no state
+# file), and write whatever it returns. Returns the state file's new
+# generation, or None if it couldn't be written.
+
+def update(path, func):
+    def change(state):
+        if state == None:
+            stories = {}
+        else:
+            stories = state["stories"]
+        return { "canto_version" : VERSION_TUPLE, "stories" : func(stories) }
+
+    try:
+        return storage.update(path, change)
+    except:
+        return None
+
+# Fill in the canto_state of each of the entries from the state file, making
+# the state file from the entries first if there isn't one. Entries that aren't
+# in the state file keep whatever state they were written with, or get
+# `default`. Returns the generation of the state used.
+
+def attach(path, entries, default):
+    generation, states = load(path)
+    if states == None:
+        def migrate(states):
+            for entry in entries:
+                if "canto_state" in entry and entry["id"] not in states:
+                    states[entry["id"]] = entry["canto_state"]
+            return states
+        update(path, migrate)
+        generation, states = load(path)
+        if states == None:
+            states = {}
+
+    for entry in entries:
+        if entry["id"] in states:
+            entry["canto_state"] = states[entry["id"]]
+        elif "canto_state" not in entry:
+            entry["canto_state"] = default[:]
+    return generation
+
+# A copy of an entry, without its state, for writing to the feed file. It's
+# only a shallow copy, the storage layer makes plain dicts of it as it writes.
+
+def strip(entry):
+    entry = copy.copy(entry)
+    if "canto_state" in entry:
+        del entry["canto_state"]
+    return entry